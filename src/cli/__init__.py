@@ -2,9 +2,30 @@ import logging
 import sys
 
 import click
-from couch.cluster import set_current_cluster, set_default_node
+from couch.auth import set_auth_mode
+from couch.balancer import BALANCERS
+from couch.breaker import set_breaker_options
+from couch.cluster import (
+    set_balancer,
+    set_current_cluster,
+    set_default_node,
+    set_hedge_percentile,
+)
+from couch.hedge import stats as hedge_stats
+from couch.http import pool_stats, set_metadata_ttl, set_pool_options
 from couch.log import logger
+from couch.metrics import enable_metrics, metrics
+from rich.console import Console
+from rich.table import Table
+from utils import (
+    RetryBudget,
+    RetryPolicy,
+    bytes_to_human,
+    set_concurrency,
+    set_retry_policy,
+)
 
+from .bench import bench
 from .cluster import clster
 from .db import db
 from .doc import doc
@@ -19,8 +40,67 @@ from .config import config
 @click.option("--node", required=False, type=int)
 @click.option("--cluster", default="default")
 @click.option("-v", "--verbose", default=False, is_flag=True)
-def main(verbose: bool, node: int | None, cluster: str):
+@click.option("--pool-size", default=32, envvar="CPG_POOL_SIZE")
+@click.option("--pool-block/--no-pool-block", default=False, envvar="CPG_POOL_BLOCK")
+@click.option("--pool-stats", "show_pool_stats", default=False, is_flag=True)
+@click.option("--stats", "show_stats", default=False, is_flag=True)
+@click.option(
+    "--auth",
+    "auth_mode",
+    default="cookie",
+    envvar="CPG_AUTH",
+    type=click.Choice(["cookie", "basic"]),
+)
+@click.option(
+    "--balancer",
+    default="random",
+    envvar="CPG_BALANCER",
+    type=click.Choice(list(BALANCERS)),
+)
+@click.option(
+    "--hedge",
+    "hedge_percentile",
+    default=None,
+    type=click.FloatRange(0, 100, min_open=True),
+)
+@click.option("--concurrency", default=32, envvar="CPG_CONCURRENCY")
+@click.option("--retry-budget", default=0.1, envvar="CPG_RETRY_BUDGET")
+@click.option("--breaker-failures", default=5, envvar="CPG_BREAKER_FAILURES")
+@click.option("--breaker-open-time", default=5.0, envvar="CPG_BREAKER_OPEN_TIME")
+@click.option("--metadata-ttl", default=1.0, envvar="CPG_METADATA_TTL")
+def main(
+    verbose: bool,
+    node: int | None,
+    cluster: str,
+    pool_size: int,
+    pool_block: bool,
+    show_pool_stats: bool,
+    show_stats: bool,
+    auth_mode: str,
+    balancer: str,
+    hedge_percentile: float | None,
+    concurrency: int,
+    retry_budget: float,
+    breaker_failures: int,
+    breaker_open_time: float,
+    metadata_ttl: float,
+):
     logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+    set_concurrency(concurrency)
+    set_retry_policy(RetryPolicy(budget=RetryBudget(ratio=retry_budget)))
+    set_auth_mode(auth_mode)
+    set_pool_options(pool_size, pool_block)
+    set_breaker_options(breaker_failures, breaker_open_time)
+    set_metadata_ttl(metadata_ttl)
+    set_balancer(balancer)
+    set_hedge_percentile(hedge_percentile)
+    if hedge_percentile is not None:
+        click.get_current_context().call_on_close(print_hedge_stats)
+    if show_pool_stats or show_stats:
+        click.get_current_context().call_on_close(print_pool_stats)
+    if show_stats:
+        enable_metrics()
+        click.get_current_context().call_on_close(print_stats)
     if "cluster" in sys.argv:
         return
 
@@ -28,6 +108,41 @@ def main(verbose: bool, node: int | None, cluster: str):
     set_default_node(node)
 
 
+def print_pool_stats():
+    table = Table(header_style="bold magenta", box=None, title="connection pools")
+    table.add_column("node")
+    table.add_column("opened", justify="right")
+    table.add_column("reused", justify="right")
+    table.add_column("discarded", justify="right")
+    for url, stats in sorted(pool_stats().items()):
+        table.add_row(url, str(stats.opened), str(stats.reused), str(stats.discarded))
+    Console().print(table)
+
+
+def print_stats():
+    table = Table(header_style="bold magenta", box=None, title="requests")
+    table.add_column("node")
+    table.add_column("endpoint")
+    for column in ["requests", "errors", "retries", "sent", "received"]:
+        table.add_column(column, justify="right")
+    for column in ["p50", "p99", "p999", "max"]:
+        table.add_column(f"{column} (ms)", justify="right")
+    for (node, endpoint), stats in metrics.items():
+        latency = stats.latency
+        table.add_row(
+            node,
+            endpoint,
+            str(stats.requests),
+            str(stats.errors),
+            str(stats.retries),
+            bytes_to_human(stats.bytes_sent),
+            bytes_to_human(stats.bytes_received),
+            *(f"{latency.percentile(p) / 1000:.1f}" for p in (50, 99, 99.9)),
+            f"{latency.max / 1000:.1f}",
+        )
+    Console().print(table)
+
+
 main.add_command(db)
 main.add_command(doc)
 main.add_command(test)
@@ -36,3 +151,11 @@ main.add_command(http)
 main.add_command(node)
 main.add_command(seed)
 main.add_command(config)
+main.add_command(bench)
+
+
+def print_hedge_stats():
+    Console().print(
+        f"hedged {hedge_stats.fired} of {hedge_stats.requests} reads, "
+        f"hedge won {hedge_stats.won}"
+    )
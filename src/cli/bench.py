@@ -0,0 +1,189 @@
+import sys
+
+import click
+from couch import microbench
+from couch.bench import KEY_DISTRIBUTIONS, Bench, BenchResult, parse_mix
+from couch.cluster import Cluster
+from rich.console import Console
+from rich.table import Table
+from utils import bytes_to_human, status
+
+
+@click.group()
+def bench():
+    pass
+
+
+@bench.command()
+@click.option("--db", "db_name", default="bench")
+@click.option("--keys", default=10000)
+@click.option("--mix", default="read=80,write=10,update=5,delete=5")
+@click.option(
+    "--distribution", default="uniform", type=click.Choice(list(KEY_DISTRIBUTIONS))
+)
+@click.option("--doc-size", default="1024")
+@click.option("--clients", default=16)
+@click.option("--rate", default=None, type=float)
+@click.option("--processes", default=1)
+@click.option("--warmup", default=5.0)
+@click.option("--duration", default=30.0)
+@click.option("--q", default=2)
+@click.option("--n", default=2)
+def run(
+    db_name: str,
+    keys: int,
+    mix: str,
+    distribution: str,
+    doc_size: str,
+    clients: int,
+    rate: float | None,
+    processes: int,
+    warmup: float,
+    duration: float,
+    q: int,
+    n: int,
+):
+    """
+    Runs a read/write/update/delete mix against DB. Without --rate, CLIENTS
+    threads each send requests back to back (closed loop); with --rate,
+    requests start at that many per second (open loop). Clients share the
+    global worker pool, so raise --concurrency to run more than it has.
+    With --processes, each process runs CLIENTS threads and the rate is
+    split between them.
+    """
+    cluster = Cluster.current()
+    b = Bench(
+        cluster,
+        db_name,
+        keys=keys,
+        mix=parse_mix(mix),
+        distribution=distribution,
+        doc_size=doc_size,
+    )
+
+    with status(f"preparing {keys} documents in {db_name}"):
+        b.prepare(q=q, n=n)
+
+    mode = "closed loop" if rate is None else f"open loop at {rate:g}/s"
+    with status(f"running for {warmup:g}s warmup + {duration:g}s ({mode})"):
+        result = b.run(
+            duration, warmup=warmup, clients=clients, rate=rate, processes=processes
+        )
+
+    print_result(result)
+
+
+@bench.command()
+@click.option("--db", "db_name", default="bench")
+def destroy(db_name: str):
+    cluster = Cluster.current()
+    cluster.db(db_name).destroy()
+    click.echo(f"destroyed db {db_name}")
+
+
+@bench.command()
+@click.option("--sizes", default=",".join(map(str, microbench.DEFAULT_SIZES)))
+@click.option(
+    "--case", "cases", multiple=True, type=click.Choice(list(microbench.CASES))
+)
+@click.option("--repeat", default=3)
+@click.option("--output", "-o", default=None, type=click.Path(dir_okay=False))
+def client(sizes: str, cases: tuple[str, ...], repeat: int, output: str | None):
+    """
+    Times the tool's own hot paths against a local fake server holding each
+    of SIZES databases, no Docker needed. With --output, the results are
+    saved as JSON for bench compare.
+    """
+    console = Console()
+
+    def on_result(result: dict):
+        console.print(
+            f"✅ {result['case']} at {result['size']}: "
+            f"{result['items_per_second']:.0f} items/s, "
+            f"{result['requests_per_second']:.0f} requests/s, "
+            f"cpu {result['cpu']:.3f}s, "
+            f"peak {bytes_to_human(result['peak_memory'])}"
+        )
+
+    report = microbench.run(
+        tuple(int(s) for s in sizes.split(",")),
+        cases=list(cases) or None,
+        repeat=repeat,
+        on_result=on_result,
+    )
+    if output is not None:
+        microbench.save(report, output)
+        click.echo(f"saved results to {output}")
+
+
+@bench.command()
+@click.argument("old", type=click.Path(exists=True, dir_okay=False))
+@click.argument("new", type=click.Path(exists=True, dir_okay=False))
+@click.option("--threshold", default=0.2)
+def compare(old: str, new: str, threshold: float):
+    """
+    Compares two bench client results, exiting non-zero if any case got
+    more than THRESHOLD (a fraction) slower, hungrier for CPU or bigger.
+    """
+    before, after = microbench.load(old), microbench.load(new)
+    rows = microbench.compare(before, after, threshold)
+
+    table = Table(
+        header_style="bold magenta",
+        box=None,
+        title=f"{before['revision'] or old} → {after['revision'] or new}",
+    )
+    table.add_column("case")
+    for column in ["size", "items/s", "cpu (s)", "peak memory"]:
+        table.add_column(column, justify="right")
+    for row in rows:
+        n, changes = row["new"], row["changes"]
+        table.add_row(
+            row["case"],
+            str(row["size"]),
+            f"{n['items_per_second']:.0f} ({changes['items_per_second']:+.1%})",
+            f"{n['cpu']:.3f} ({changes['cpu']:+.1%})",
+            f"{bytes_to_human(n['peak_memory'])} ({changes['peak_memory']:+.1%})",
+            style="red" if row["regressed"] else None,
+        )
+    Console().print(table)
+
+    if any(row["regressed"] for row in rows):
+        sys.exit(1)
+
+
+def print_result(result: BenchResult):
+    console = Console()
+
+    table = Table(header_style="bold magenta", box=None, title="operations")
+    table.add_column("op")
+    for column in ["ops", "ops/s", "errors", "sent", "received"]:
+        table.add_column(column, justify="right")
+    for column in ["p50", "p90", "p99", "p999", "max"]:
+        table.add_column(f"{column} (ms)", justify="right")
+    table.add_column("statuses")
+    for op, stats in result.ops.items():
+        if stats.requests == 0:
+            continue
+        latency = stats.latency
+        table.add_row(
+            op,
+            str(stats.requests),
+            f"{result.throughput(stats.requests):.1f}",
+            str(stats.errors),
+            bytes_to_human(stats.bytes_sent),
+            bytes_to_human(stats.bytes_received),
+            *(f"{latency.percentile(p) / 1000:.1f}" for p in (50, 90, 99, 99.9)),
+            f"{latency.max / 1000:.1f}",
+            " ".join(f"{s}:{n}" for s, n in sorted(stats.statuses.items())),
+        )
+    console.print(table)
+
+    table = Table(header_style="bold magenta", box=None, title="nodes")
+    table.add_column("node")
+    table.add_column("ops", justify="right")
+    table.add_column("ops/s", justify="right")
+    for node, requests in sorted(result.nodes.items()):
+        table.add_row(node, str(requests), f"{result.throughput(requests):.1f}")
+    table.add_row("total", str(result.requests), f"{result.throughput():.1f}")
+    console.print(table)
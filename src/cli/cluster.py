@@ -1,6 +1,6 @@
 import click
-import docker
 from couch.cluster import Cluster
+from couch.containers import docker_client
 from rich.console import Console
 from rich.table import Table
 from utils import parallel_map
@@ -98,7 +98,7 @@ def destroy(name: str):
 
 @clster.command("list")
 def ls():
-    client = docker.from_env()
+    client = docker_client()
     table = Table(
         show_header=True,
         header_style="bold magenta",
@@ -33,7 +33,8 @@ def get(name: str):
 
 
 @db.command()
-def list():
+@click.option("--depth", default=2)
+def list(depth: int):
     cluster = Cluster.current()
     console = Console()
 
@@ -45,7 +46,8 @@ def list():
         table.add_column("n")
         table.add_column("r")
         table.add_column("w")
-        for info in cluster.dbs_info((db.name for db in cluster.dbs())):
+        names = (db.name for db in cluster.dbs(prefetch_pages=depth))
+        for info in cluster.dbs_info(names, depth=depth):
             if "error" in info:
                 continue
             table.add_row(
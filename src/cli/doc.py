@@ -1,11 +1,16 @@
 import json
+import os
+import time
+from typing import IO, Any, Generator
 
 import click
 from couch.cluster import Cluster
 from rich.console import Console
 from rich.syntax import Syntax
 from rich.table import Table
-from utils import bytes_to_human
+from utils import bytes_to_human, status
+
+from .options import rate_limit_options
 
 
 @click.group()
@@ -25,7 +30,8 @@ def create(db_name: str, body: str):
 
 @doc.command()
 @click.argument("db")
-def list(db: str):
+@click.option("--page-size", default=1000)
+def list(db: str, page_size: int):
     cluster = Cluster.current()
     table = Table(header_style="bold magenta", box=None, show_lines=True)
     table.add_column("id")
@@ -33,10 +39,148 @@ def list(db: str):
     table.add_column("size")
     table.add_column("body")
 
-    for doc in cluster.db(db).list():
-        raw = json.dumps(doc.get(), indent=2)
+    for doc in cluster.db(db).list(page_size=page_size, include_docs=True):
+        raw = json.dumps(doc.body, indent=2)
         highlighted = Syntax(raw, "json")
         table.add_row(doc.id, doc.rev, bytes_to_human(len(raw)), highlighted)
 
     console = Console()
     console.print(table)
+
+
+@doc.command("import")
+@rate_limit_options
+@click.argument("db_name")
+@click.argument("file", type=click.File("r"))
+@click.option("--batch-size", default=1000)
+def import_(db_name: str, file: IO[str], batch_size: int):
+    """Import newline-delimited JSON documents from FILE ("-" for stdin)."""
+    cluster = Cluster.current()
+    db = cluster.db(db_name)
+
+    def docs() -> Generator[dict[str, Any], None, None]:
+        for line in file:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+    imported = 0
+    table = Table(header_style="bold magenta", box=None, show_lines=True)
+    table.add_column("id")
+    table.add_column("error")
+    table.add_column("reason")
+
+    with status(f"importing docs into {db_name}"):
+        for result in db.insert_many(docs(), batch_size=batch_size):
+            if "error" in result:
+                table.add_row(result["id"], result["error"], result["reason"])
+            else:
+                imported += 1
+
+    console = Console()
+    console.print(f"imported {imported} docs, {table.row_count} errors")
+    if table.row_count > 0:
+        console.print(table)
+        exit(1)
+
+
+@doc.command()
+@click.argument("db_name")
+@click.option("--partitions", default=None, type=int)
+@click.option("--ordered", default=False, is_flag=True)
+def dump(db_name: str, partitions: int | None, ordered: bool):
+    """
+    Write every document as newline-delimited JSON, without revisions, in a
+    form `doc import` can load.
+    """
+    cluster = Cluster.current()
+    db = cluster.db(db_name)
+    docs = db.scan(
+        partitions=partitions or len(cluster.nodes),
+        nodes=cluster.nodes,
+        ordered=ordered,
+        include_docs=True,
+    )
+    for d in docs:
+        assert d.body is not None
+        body = {k: v for k, v in d.body.items() if k != "_rev"}
+        click.echo(json.dumps(body))
+
+
+@doc.command()
+@click.argument("db_name")
+@click.option(
+    "--feed", default="continuous", type=click.Choice(["longpoll", "continuous"])
+)
+@click.option("--since", default="now")
+@click.option("--include-docs", default=False, is_flag=True)
+@click.option("--filter", "filter_", default=None)
+@click.option("--checkpoint", default=None, type=click.Path(dir_okay=False))
+@click.option("--quiet", "-q", default=False, is_flag=True)
+def watch(
+    db_name: str,
+    feed: str,
+    since: str,
+    include_docs: bool,
+    filter_: str | None,
+    checkpoint: str | None,
+    quiet: bool,
+):
+    """Tail a database's changes feed."""
+    cluster = Cluster.current()
+    db = cluster.db(db_name)
+    console = Console()
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            since = f.read().strip() or since
+
+    def save(seq: str):
+        if checkpoint is not None:
+            with open(checkpoint, "w") as f:
+                f.write(seq)
+
+    count = 0
+    last_seq: str | None = None
+
+    def seen(seq: str):
+        nonlocal last_seq
+        last_seq = seq
+    last_save = start = time.monotonic()
+    with console.status(f" watching {db_name}") as s:
+        try:
+            for change in db.changes(
+                feed=feed,
+                since=since,
+                include_docs=include_docs,
+                filter=filter_,
+                on_checkpoint=seen,
+            ):
+                count += 1
+                last_seq = change["seq"]
+                if not quiet:
+                    revs = ", ".join(c["rev"] for c in change["changes"])
+                    deleted = " (deleted)" if change.get("deleted") else ""
+                    console.print(f"{change['id']} {revs}{deleted}", highlight=False)
+                    if include_docs and "doc" in change:
+                        raw = json.dumps(change["doc"], indent=2)
+                        console.print(Syntax(raw, "json"))
+
+                now = time.monotonic()
+                s.update(
+                    f" watching {db_name}: {count} changes, "
+                    f"{count / max(now - start, 1e-9):.1f}/s"
+                )
+                if now - last_save >= 1:
+                    save(last_seq)
+                    last_save = now
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if last_seq is not None:
+                save(last_seq)
+
+    elapsed = time.monotonic() - start
+    console.print(
+        f"saw {count} changes in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.1f}/s)"
+    )
@@ -0,0 +1,28 @@
+from typing import Any
+
+import click
+from couch.http import set_rate_limits
+
+
+def _set_rate_limit(ctx: click.Context, param: click.Parameter, value: Any):
+    if value is not None:
+        set_rate_limits(**{str(param.name): value})
+
+
+def rate_limit_options(f):
+    """
+    Adds --rate, --burst and --node-rate to a command. They cap requests
+    per second to the whole cluster and to each node, so load is applied at
+    a fixed rate rather than as fast as the worker threads can go.
+    """
+    for name, kind in reversed(
+        [("--rate", float), ("--burst", int), ("--node-rate", float)]
+    ):
+        f = click.option(
+            name,
+            type=kind,
+            default=None,
+            expose_value=False,
+            callback=_set_rate_limit,
+        )(f)
+    return f
@@ -1,6 +1,11 @@
+import asyncio
+
 import click
+from couch.aio import AsyncCluster
 from couch.cluster import Cluster
 
+from .options import rate_limit_options
+
 
 @click.group()
 def seed():
@@ -8,26 +13,61 @@ def seed():
 
 
 @seed.command()
+@rate_limit_options
 @click.option("--num-dbs", default=100)
 @click.option("--docs-per-db", default=1)
-def create(num_dbs: int, docs_per_db: int):
+@click.option("--batch-size", default=1000)
+@click.option("--use-async", default=False, is_flag=True)
+@click.option("--use-db-updates", default=False, is_flag=True)
+@click.option("--processes", default=1)
+def create(
+    num_dbs: int,
+    docs_per_db: int,
+    batch_size: int,
+    use_async: bool,
+    use_db_updates: bool,
+    processes: int,
+):
+    if use_async:
+        if processes != 1 or use_db_updates:
+            raise click.UsageError(
+                "--processes and --use-db-updates can't be used with --use-async"
+            )
+        asyncio.run(create_async(num_dbs, docs_per_db, batch_size))
+        return
+
     cluster = Cluster.current()
-    cluster.seed(num_dbs, docs_per_db)
-    cluster.wait_for_seed(num_dbs, docs_per_db)
+    cluster.seed(num_dbs, docs_per_db, batch_size=batch_size, processes=processes)
+    cluster.wait_for_seed(num_dbs, docs_per_db, use_db_updates=use_db_updates)
+
+
+async def create_async(num_dbs: int, docs_per_db: int, batch_size: int):
+    async with AsyncCluster.current() as cluster:
+        await cluster.seed(num_dbs, docs_per_db, batch_size=batch_size)
+        await cluster.wait_for_seed(num_dbs, docs_per_db)
 
 
 @seed.command()
 @click.option("--num-dbs", default=100)
 @click.option("--docs-per-db", default=1)
-def validate(num_dbs: int, docs_per_db: int):
-    cluster = Cluster.current()
-
+@click.option("--use-async", default=False, is_flag=True)
+@click.option("--partitions", default=1)
+def validate(num_dbs: int, docs_per_db: int, use_async: bool, partitions: int):
     try:
-        cluster.validate_seed(num_dbs, docs_per_db)
+        if use_async:
+            asyncio.run(validate_async(num_dbs, docs_per_db))
+        else:
+            cluster = Cluster.current()
+            cluster.validate_seed(num_dbs, docs_per_db, partitions=partitions)
     except Exception:
         exit(1)
 
 
+async def validate_async(num_dbs: int, docs_per_db: int):
+    async with AsyncCluster.current() as cluster:
+        await cluster.validate_seed(num_dbs, docs_per_db)
+
+
 @seed.command()
 def destroy():
     cluster = Cluster.current()
@@ -1,103 +1,366 @@
+import asyncio
 import click
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from random import shuffle
+from typing import Iterable
+from couch import results
+from couch.aio import AsyncCluster
 from couch.cluster import Cluster
+from couch.node import Node
 from rich.console import Console
-from utils import no_retries, parallel_iter_with_progress
+from rich.table import Table
+from utils import (
+    async_parallel_iter_with_progress,
+    no_retries,
+    parallel_iter_with_progress,
+)
+
+from .options import rate_limit_options
+
+SCENARIOS = ["lose_data", "safely_add_node"]
 
 
 @click.group()
-def test():
-    pass
+@click.option("--results-dir", default=results.results_dir(), envvar="CPG_RESULTS_DIR")
+def test(results_dir: str):
+    """
+    Scenarios that try to lose data. Each run is saved to the results store
+    in RESULTS_DIR, with its phase timings and error rates, for test compare.
+    """
+    results.set_results_dir(results_dir)
+
+
+def spam_creates(node: Node, indexes: Iterable[int], parallelism: int):
+    """
+    Sends a create for db-{i} to node for every index, parallelism at a
+    time, ignoring failures. The shared pool is capped at --concurrency,
+    far below the burst these scenarios rely on, so this runs on a pool of
+    its own.
+    """
+
+    def do(i: int):
+        try:
+            with no_retries():
+                node.db(f"db-{i}").create()
+        except Exception:
+            pass
+
+    parallelism = max(1, parallelism)
+    with ThreadPoolExecutor(parallelism, thread_name_prefix="spam") as executor:
+        parallel_iter_with_progress(
+            do,
+            indexes,
+            description="spamming create db requests to new node",
+            parallelism=parallelism,
+            executor=executor,
+        )
 
 
 @test.command()
+@rate_limit_options
 @click.option("--num-dbs", default=2000)
 @click.option("--docs-per-db", default=1)
-def lose_data(num_dbs: int, docs_per_db: int):
+@click.option("--use-async", default=False, is_flag=True)
+def lose_data(num_dbs: int, docs_per_db: int, use_async: bool):
+    if use_async:
+        asyncio.run(lose_data_async(num_dbs, docs_per_db))
+        return
+
     cluster = Cluster.current()
     console = Console()
 
-    console.print("🕵️  checking to see if we can re-use existing data")
-    try:
-        cluster.validate_seed(num_dbs, docs_per_db)
-        console.print("✅ existing data is valid, re-using")
-    except Exception:
-        console.print("❌ existing data is invalid, re-seeding")
-        cluster.destroy_seed_data()
-        cluster.seed(num_dbs, docs_per_db)
-        cluster.wait_for_seed(num_dbs, docs_per_db)
-
-    while True:
-        node = cluster.nodes[-1]
-        node.destroy()
-        node = cluster.add_node()
-
-        def do(i):
+    with results.record(
+        "lose_data", cluster, num_dbs=num_dbs, docs_per_db=docs_per_db
+    ) as run:
+        console.print("🕵️  checking to see if we can re-use existing data")
+        try:
+            with run.phase("validate_existing"):
+                cluster.validate_seed(num_dbs, docs_per_db)
+            console.print("✅ existing data is valid, re-using")
+        except Exception:
+            console.print("❌ existing data is invalid, re-seeding")
+            with run.phase("seed"):
+                cluster.destroy_seed_data()
+                cluster.seed(num_dbs, docs_per_db)
+            with run.phase("wait_for_seed"):
+                cluster.wait_for_seed(num_dbs, docs_per_db)
+        run.shards(cluster)
+
+        while True:
+            with run.phase("replace_node"):
+                node = cluster.nodes[-1]
+                node.destroy()
+                node = cluster.add_node()
+
+            with run.phase("create_on_new_node"):
+                spam_creates(node, range(num_dbs), parallelism=num_dbs)
+
             try:
-                with no_retries():
-                    node.db(f"db-{i}").create()
+                with run.phase("converge"):
+                    cluster.wait_for_seed(num_dbs, docs_per_db, timeout=10)
             except Exception:
-                pass
+                console.print("❌ failure while syncing")
+                console.print_exception(max_frames=3)
 
-        parallel_iter_with_progress(
-            do,
-            range(num_dbs),
-            description="spamming create db requests to new node",
-            parallelism=num_dbs,
-        )
+            try:
+                with run.phase("validate"):
+                    cluster.validate_seed(num_dbs, docs_per_db)
+                console.print("no data loss detected, retrying")
+            except Exception as e:
+                console.print(f"detected data loss: {e}")
+                run.outcome = "data_loss"
+                break
 
-        try:
-            cluster.wait_for_seed(num_dbs, docs_per_db, timeout=10)
-        except Exception:
-            console.print("❌ failure while syncing")
-            console.print_exception(max_frames=3)
 
-        try:
-            cluster.validate_seed(num_dbs, docs_per_db)
-            console.print("no data loss detected, retrying")
-        except Exception as e:
-            console.print(f"detected data loss: {e}")
-            break
+async def lose_data_async(num_dbs: int, docs_per_db: int):
+    console = Console()
+
+    async with AsyncCluster.current() as cluster:
+        with results.record(
+            "lose_data",
+            cluster.cluster,
+            num_dbs=num_dbs,
+            docs_per_db=docs_per_db,
+            use_async=True,
+        ) as run:
+            console.print("🕵️  checking to see if we can re-use existing data")
+            try:
+                with run.phase("validate_existing"):
+                    await cluster.validate_seed(num_dbs, docs_per_db)
+                console.print("✅ existing data is valid, re-using")
+            except Exception:
+                console.print("❌ existing data is invalid, re-seeding")
+                with run.phase("seed"):
+                    await cluster.destroy_seed_data()
+                    await cluster.seed(num_dbs, docs_per_db)
+                with run.phase("wait_for_seed"):
+                    await cluster.wait_for_seed(num_dbs, docs_per_db)
+            run.shards(cluster.cluster)
+
+            while True:
+                with run.phase("replace_node"):
+                    node = cluster.cluster.nodes[-1]
+                    node.destroy()
+                    new_node = cluster.node(cluster.cluster.add_node())
+
+                async def do(i):
+                    try:
+                        with no_retries():
+                            await new_node.db(f"db-{i}").create()
+                    except Exception:
+                        pass
+
+                with run.phase("create_on_new_node"):
+                    await async_parallel_iter_with_progress(
+                        do,
+                        range(num_dbs),
+                        description="spamming create db requests to new node",
+                        parallelism=num_dbs,
+                    )
+
+                try:
+                    with run.phase("converge"):
+                        await cluster.wait_for_seed(num_dbs, docs_per_db, timeout=10)
+                except Exception:
+                    console.print("❌ failure while syncing")
+                    console.print_exception(max_frames=3)
+
+                try:
+                    with run.phase("validate"):
+                        await cluster.validate_seed(num_dbs, docs_per_db)
+                    console.print("no data loss detected, retrying")
+                except Exception as e:
+                    console.print(f"detected data loss: {e}")
+                    run.outcome = "data_loss"
+                    break
 
 
 @test.command()
+@rate_limit_options
 @click.option("--unsafe", default=False, is_flag=True)
 @click.option("--num-dbs", default=1000)
 @click.option("--docs-per-db", default=1)
-def safely_add_node(unsafe: bool, num_dbs: int, docs_per_db: int):
+@click.option("--use-async", default=False, is_flag=True)
+def safely_add_node(unsafe: bool, num_dbs: int, docs_per_db: int, use_async: bool):
+    if use_async:
+        asyncio.run(safely_add_node_async(unsafe, num_dbs, docs_per_db))
+        return
+
     cluster = Cluster.current()
     console = Console()
 
-    try:
-        cluster.validate_seed(num_dbs, docs_per_db)
-    except Exception:
-        cluster.destroy_seed_data()
-        cluster.seed(num_dbs, docs_per_db)
-        cluster.wait_for_seed(num_dbs, docs_per_db)
+    with results.record(
+        "safely_add_node",
+        cluster,
+        num_dbs=num_dbs,
+        docs_per_db=docs_per_db,
+        unsafe=unsafe,
+    ) as run:
+        try:
+            with run.phase("validate_existing"):
+                cluster.validate_seed(num_dbs, docs_per_db)
+        except Exception:
+            with run.phase("seed"):
+                cluster.destroy_seed_data()
+                cluster.seed(num_dbs, docs_per_db)
+            with run.phase("wait_for_seed"):
+                cluster.wait_for_seed(num_dbs, docs_per_db)
+        run.shards(cluster)
+
+        with run.phase("add_node"):
+            node = cluster.add_node(maintenance_mode=not unsafe)
+            if not unsafe:
+                node.set_config("couchdb", "maintenance_mode", "false")
 
-    node = cluster.add_node(maintenance_mode=not unsafe)
-    if not unsafe:
-        node.set_config("couchdb", "maintenance_mode", "false")
+        indexes = list(range(num_dbs))
+        shuffle(indexes)
+        with run.phase("create_on_new_node"):
+            spam_creates(node, indexes, parallelism=num_dbs // 4)
+
+        with run.phase("converge"):
+            cluster.wait_for_seed(num_dbs, docs_per_db)
 
-    def do(i):
         try:
-            with no_retries():
-                node.db(f"db-{i}").create()
-        except Exception:
-            pass
+            with run.phase("validate"):
+                cluster.validate_seed(num_dbs, docs_per_db)
+            console.print("all nodes in sync, new node added safely")
+            run.outcome = "passed"
+        except Exception as e:
+            console.print(f"detected data loss: {e}")
+            run.outcome = "data_loss"
+
+    if run.outcome == "data_loss":
+        exit(1)
+
+
+async def safely_add_node_async(unsafe: bool, num_dbs: int, docs_per_db: int):
+    console = Console()
+
+    async with AsyncCluster.current() as cluster:
+        with results.record(
+            "safely_add_node",
+            cluster.cluster,
+            num_dbs=num_dbs,
+            docs_per_db=docs_per_db,
+            unsafe=unsafe,
+            use_async=True,
+        ) as run:
+            try:
+                with run.phase("validate_existing"):
+                    await cluster.validate_seed(num_dbs, docs_per_db)
+            except Exception:
+                with run.phase("seed"):
+                    await cluster.destroy_seed_data()
+                    await cluster.seed(num_dbs, docs_per_db)
+                with run.phase("wait_for_seed"):
+                    await cluster.wait_for_seed(num_dbs, docs_per_db)
+            run.shards(cluster.cluster)
+
+            with run.phase("add_node"):
+                node = cluster.cluster.add_node(maintenance_mode=not unsafe)
+                if not unsafe:
+                    node.set_config("couchdb", "maintenance_mode", "false")
+                new_node = cluster.node(node)
+
+            async def do(i):
+                try:
+                    with no_retries():
+                        await new_node.db(f"db-{i}").create()
+                except Exception:
+                    pass
 
-    parallel_iter_with_progress(
-        do,
-        shuffle(range(num_dbs)),
-        description="spamming create db requests to new node",
-        parallelism=num_dbs // 4,
-    )
+            indexes = list(range(num_dbs))
+            shuffle(indexes)
+            with run.phase("create_on_new_node"):
+                await async_parallel_iter_with_progress(
+                    do,
+                    indexes,
+                    description="spamming create db requests to new node",
+                    parallelism=num_dbs // 4,
+                )
 
-    cluster.wait_for_seed(num_dbs, docs_per_db)
+            with run.phase("converge"):
+                await cluster.wait_for_seed(num_dbs, docs_per_db)
+
+            try:
+                with run.phase("validate"):
+                    await cluster.validate_seed(num_dbs, docs_per_db)
+                console.print("all nodes in sync, new node added safely")
+                run.outcome = "passed"
+            except Exception as e:
+                console.print(f"detected data loss: {e}")
+                run.outcome = "data_loss"
 
-    try:
-        cluster.validate_seed(num_dbs, docs_per_db)
-        console.print("all nodes in sync, new node added safely")
-    except Exception as e:
-        console.print(f"detected data loss: {e}")
+    if run.outcome == "data_loss":
         exit(1)
+
+
+@test.command()
+@click.option("--scenario", default=None, type=click.Choice(SCENARIOS))
+def runs(scenario: str | None):
+    """Lists the runs in the results store."""
+    table = Table(header_style="bold magenta", box=None)
+    for column in ["id", "image", "nodes", "q", "n", "outcome"]:
+        table.add_column(column)
+    table.add_column("time (s)", justify="right")
+    for run in results.load_runs(scenario):
+        table.add_row(
+            run["id"],
+            run["image"],
+            str(run["nodes"]),
+            str(run["q"]),
+            str(run["n"]),
+            run["outcome"],
+            f"{sum(p['seconds'] for p in run['phases']):.1f}",
+        )
+    Console().print(table)
+
+
+@test.command()
+@click.argument("old")
+@click.argument("new")
+@click.option("--scenario", default=None, type=click.Choice(SCENARIOS))
+def compare(old: str, new: str, scenario: str | None):
+    """
+    Compares the phase timings and error rates of two sets of runs, each
+    either a run id or an image tag (all runs of that image), e.g.
+    `test compare couchdb:3.2.1 couchdb:3.3.3`.
+    """
+    console = Console()
+    stored = results.load_runs(scenario)
+    before, after = results.select(stored, old), results.select(stored, new)
+    if not before or not after:
+        console.print(f"❌ no runs found for {old if not before else new}")
+        exit(1)
+
+    for name in sorted({r["scenario"] for r in before + after}):
+        o = [r for r in before if r["scenario"] == name]
+        n = [r for r in after if r["scenario"] == name]
+        if not o or not n:
+            continue
+
+        table = Table(
+            header_style="bold magenta",
+            box=None,
+            title=f"{name}: {old} ({_outcomes(o)}) → {new} ({_outcomes(n)})",
+        )
+        table.add_column("phase")
+        for column in ["old (s)", "new (s)", "change", "old errors", "new errors"]:
+            table.add_column(column, justify="right")
+        for row in results.compare(o, n):
+            old_phase, new_phase, change = row["old"], row["new"], row["change"]
+            table.add_row(
+                row["phase"],
+                f"{old_phase['seconds']:.2f}" if old_phase else "-",
+                f"{new_phase['seconds']:.2f}" if new_phase else "-",
+                f"{change:+.1%}" if change is not None else "-",
+                f"{old_phase['error_rate']:.2%}" if old_phase else "-",
+                f"{new_phase['error_rate']:.2%}" if new_phase else "-",
+            )
+        console.print(table)
+
+
+def _outcomes(runs: list[dict]) -> str:
+    counts = Counter(r["outcome"] for r in runs)
+    return ", ".join(f"{n} {outcome}" for outcome, n in counts.most_common())
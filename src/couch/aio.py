@@ -0,0 +1,454 @@
+import asyncio
+import json as json_module
+from datetime import datetime
+from typing import Any, AsyncGenerator, AsyncIterable
+
+import aiohttp
+from rich.progress import Progress, TaskID
+
+from couch.auth import AsyncAuth
+from couch.http import rate_limiters
+from couch.log import logger
+from couch.metrics import metrics, metrics_enabled
+from couch.types import BulkDocResult, DatabaseResponse, DBInfo
+from utils import async_parallel_iter_with_progress, async_retry, progress, status
+
+from .cluster import Cluster
+from .convergence import print_convergence, seed_db_names
+from .node import Node
+
+
+class AsyncHTTPMixin:
+    def base_url(self) -> str:
+        raise NotImplementedError
+
+    def session(self) -> aiohttp.ClientSession:
+        raise NotImplementedError
+
+    def auth(self) -> AsyncAuth:
+        raise NotImplementedError
+
+    async def _send(
+        self,
+        method: str,
+        url: str,
+        json: Any,
+        timeout: float,
+        headers: dict[str, str],
+    ) -> aiohttp.ClientResponse:
+        base_url = self.base_url()
+        for limiter in rate_limiters(base_url):
+            await limiter.acquire_async()
+        path = url.removeprefix(base_url)
+        with metrics.measure(base_url, method, path) as sample:
+            async with self.session().request(
+                method,
+                url,
+                json=json,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+                headers=headers,
+            ) as resp:
+                # Read the body before the connection is released so that
+                # callers can still call resp.json() afterwards.
+                body = await resp.read()
+                if metrics_enabled():
+                    sent = len(json_module.dumps(json)) if json is not None else 0
+                    sample.response(resp.status, sent, len(body))
+                return resp
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        json: Any = None,
+        max_attempts: int = 3,
+        initial_wait: float = 1,
+        backoff_factor: float = 2,
+        timeout: float = 5,
+    ) -> aiohttp.ClientResponse:
+        url = f"{self.base_url()}{path}"
+        auth = self.auth()
+        attempts = 0
+
+        @async_retry(max_attempts, initial_wait, backoff_factor)
+        async def req():
+            nonlocal attempts
+            attempts += 1
+            if attempts > 1:
+                metrics.retried(self.base_url(), method, path)
+            generation = await auth.ensure()
+            resp = await self._send(method, url, json, timeout, auth.headers())
+            if resp.status == 401:
+                await auth.reauthenticate(generation)
+                resp = await self._send(method, url, json, timeout, auth.headers())
+            logger.debug(f"{method} {url} {resp.status}")
+            if not resp.ok:
+                logger.debug(await resp.text())
+            resp.raise_for_status()
+            return resp
+
+        return await req()
+
+    async def get(self, path: str, **kwargs) -> aiohttp.ClientResponse:
+        return await self.request("GET", path, **kwargs)
+
+    async def post(
+        self, path: str, json: Any = None, **kwargs
+    ) -> aiohttp.ClientResponse:
+        return await self.request("POST", path, json, **kwargs)
+
+    async def put(
+        self, path: str, json: Any = None, **kwargs
+    ) -> aiohttp.ClientResponse:
+        return await self.request("PUT", path, json, **kwargs)
+
+    async def delete(self, path: str, **kwargs) -> aiohttp.ClientResponse:
+        return await self.request("DELETE", path, **kwargs)
+
+
+class AsyncDB:
+    node: "AsyncNode"
+    name: str
+
+    def __init__(self, node: "AsyncNode", name: str):
+        self.node = node
+        self.name = name
+
+    def __str__(self) -> str:
+        return self.name
+
+    async def create(self, q: int = 2, n: int = 2) -> "AsyncDB":
+        await self.node.put(f"/{self.name}?q={q}&n={n}")
+        return self
+
+    async def insert_many(
+        self, docs: list[dict[str, Any]], batch_size: int = 1000, timeout: float = 30
+    ) -> AsyncGenerator[BulkDocResult, None]:
+        for i in range(0, len(docs), batch_size):
+            resp = await self.node.post(
+                f"/{self.name}/_bulk_docs",
+                json={"docs": docs[i : i + batch_size]},
+                timeout=timeout,
+            )
+            for result in await resp.json():
+                compact: BulkDocResult = {"id": result["id"]}
+                if "rev" in result:
+                    compact["rev"] = result["rev"]
+                if "error" in result:
+                    compact["error"] = result["error"]
+                    compact["reason"] = result.get("reason", "")
+                yield compact
+
+    async def count(self) -> int:
+        return (await self.describe())["doc_count"]
+
+    async def exists(self) -> bool:
+        try:
+            await self.describe()
+            return True
+        except aiohttp.ClientResponseError as e:
+            if e.status == 404:
+                return False
+            raise e
+
+    async def destroy(self):
+        await self.node.delete(f"/{self.name}")
+
+    async def describe(self) -> DatabaseResponse:
+        resp = await self.node.get(f"/{self.name}")
+        return await resp.json()
+
+
+class AsyncNode(AsyncHTTPMixin):
+    """
+    An asyncio view of a Node. Container management stays on the wrapped
+    Node; only HTTP traffic goes through the event loop.
+    """
+
+    cluster: "AsyncCluster"
+    node: Node
+
+    def __init__(self, cluster: "AsyncCluster", node: Node):
+        self.cluster = cluster
+        self.node = node
+
+    @property
+    def index(self) -> int:
+        return self.node.index
+
+    def base_url(self) -> str:
+        return self.node.local_address
+
+    def session(self) -> aiohttp.ClientSession:
+        return self.cluster.session()
+
+    def auth(self) -> AsyncAuth:
+        return self.cluster.auth_for(self.base_url())
+
+    def db(self, name: str) -> AsyncDB:
+        return AsyncDB(self, name)
+
+    async def dbs(
+        self,
+        page_size: int = 100,
+        start_key: str | None = None,
+        end_key: str | None = None,
+    ) -> AsyncGenerator[AsyncDB, None]:
+        while True:
+            url = f"/_all_dbs?limit={page_size + 1}"
+            if start_key:
+                url += f'&startkey="{start_key}"'
+            if end_key:
+                url += f'&endkey="{end_key}"'
+            names = await (await self.get(url)).json()
+
+            for name in names[:page_size]:
+                yield AsyncDB(self, name)
+
+            if len(names) == page_size + 1:
+                start_key = names[-1]
+            else:
+                break
+
+    async def dbs_info(
+        self, db_names: AsyncIterable[str], page_size: int = 100
+    ) -> AsyncGenerator[DBInfo, None]:
+        batch: list[str] = []
+        async for name in db_names:
+            batch.append(name)
+            if len(batch) == page_size:
+                for info in await self._dbs_info(batch):
+                    yield info
+                batch = []
+        if batch:
+            for info in await self._dbs_info(batch):
+                yield info
+
+    async def _dbs_info(self, batch: list[str]) -> list[DBInfo]:
+        resp = await self.post("/_dbs_info", json={"keys": batch})
+        return await resp.json()
+
+    async def _seed_db_names(self) -> AsyncGenerator[str, None]:
+        async for db in self.dbs(start_key="db-", end_key="db-\ufff0"):
+            yield db.name
+
+    async def validate_seed(
+        self,
+        num_dbs: int,
+        docs_per_db: int,
+        pbar: Progress | None = None,
+        task_id: TaskID | None = None,
+    ):
+        total = 0
+        if pbar is not None and task_id is not None:
+            pbar.update(
+                task_id,
+                total=num_dbs,
+                description=f"node:{self.index} validating seed data",
+            )
+        async for info in self.dbs_info(self._seed_db_names()):
+            total += 1
+            if pbar is not None and task_id is not None:
+                pbar.update(task_id, advance=1)
+            if "error" in info:
+                continue
+            if info["info"]["doc_count"] != docs_per_db:
+                if pbar is not None and task_id is not None:
+                    pbar.update(
+                        task_id,
+                        description=f"❌ node:{self.index} {info['key']} expected {docs_per_db} docs, got {info['info']['doc_count']}",
+                    )
+                raise Exception(f"{info['key']} has {info['info']['doc_count']} docs")
+
+        if total != num_dbs:
+            if pbar is not None and task_id is not None:
+                pbar.update(
+                    task_id,
+                    description=f"❌ node:{self.index} expected {num_dbs} dbs, got {total}",
+                )
+            raise Exception(f"expected {num_dbs} dbs, got {total}")
+
+        if pbar is not None and task_id is not None:
+            pbar.update(
+                task_id,
+                description=f"✅ node:{self.index} validated seed data",
+            )
+
+    async def wait_for_seed(
+        self, num_dbs: int, docs_per_db: int, timeout: int = 60
+    ) -> dict[str, datetime]:
+        pending = seed_db_names(num_dbs)
+        converged: dict[str, datetime] = {}
+
+        async def names() -> AsyncGenerator[str, None]:
+            for name in sorted(pending):
+                yield name
+
+        start = datetime.now()
+        while True:
+            async for info in self.dbs_info(names()):
+                if "error" in info:
+                    continue
+                if info["info"]["doc_count"] == docs_per_db:
+                    pending.discard(info["key"])
+                    converged[info["key"]] = datetime.now()
+            if not pending:
+                return converged
+            elapsed = (datetime.now() - start).total_seconds()
+            if elapsed > timeout:
+                raise Exception(
+                    f"timed out waiting for seed data to be created (elapsed={elapsed}s, pending={len(pending)})"
+                )
+            await asyncio.sleep(0.5)
+
+
+class AsyncCluster(AsyncHTTPMixin):
+    """
+    An asyncio view of a Cluster, used as an async context manager:
+
+        async with AsyncCluster(Cluster.current()) as cluster:
+            await cluster.seed(2000, 1)
+    """
+
+    cluster: Cluster
+    connection_limit: int
+    _session: aiohttp.ClientSession | None
+    _auths: dict[str, AsyncAuth]
+
+    def __init__(self, cluster: Cluster, connection_limit: int = 0):
+        self.cluster = cluster
+        self.connection_limit = connection_limit
+        self._session = None
+        self._auths = {}
+
+    @staticmethod
+    def current(connection_limit: int = 0) -> "AsyncCluster":
+        return AsyncCluster(Cluster.current(), connection_limit=connection_limit)
+
+    async def __aenter__(self) -> "AsyncCluster":
+        self._session = aiohttp.ClientSession(
+            # CouchDB sets its AuthSession cookie for "localhost", which the
+            # default strict cookie jar refuses to store.
+            cookie_jar=aiohttp.CookieJar(unsafe=True),
+            connector=aiohttp.TCPConnector(limit=self.connection_limit),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self._auths.clear()
+
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            raise RuntimeError("AsyncCluster must be used with `async with`")
+        return self._session
+
+    def auth(self) -> AsyncAuth:
+        return self.default_node.auth()
+
+    def auth_for(self, base_url: str) -> AsyncAuth:
+        """One AsyncAuth per node, shared by every request in this session."""
+        if base_url not in self._auths:
+            self._auths[base_url] = AsyncAuth(base_url, self.session())
+        return self._auths[base_url]
+
+    @property
+    def nodes(self) -> list[AsyncNode]:
+        return [AsyncNode(self, node) for node in self.cluster.nodes]
+
+    @property
+    def default_node(self) -> AsyncNode:
+        return AsyncNode(self, self.cluster.default_node)
+
+    def node(self, node: Node) -> AsyncNode:
+        return AsyncNode(self, node)
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        json: Any = None,
+        max_attempts: int = 3,
+        initial_wait: float = 1,
+        backoff_factor: float = 2,
+        timeout: float = 5,
+    ) -> aiohttp.ClientResponse:
+        attempts = 0
+
+        @async_retry(max_attempts, initial_wait, backoff_factor)
+        async def req() -> aiohttp.ClientResponse:
+            nonlocal attempts
+            attempts += 1
+            if attempts > 1:
+                metrics.retried(self.cluster.cache_key(), method, path)
+            return await self.default_node.request(
+                method, path, json, max_attempts=1, timeout=timeout
+            )
+
+        return await req()
+
+    def db(self, name: str) -> AsyncDB:
+        return self.default_node.db(name)
+
+    def dbs(
+        self, limit: int = 100, start_key: str | None = None, end_key: str | None = None
+    ) -> AsyncGenerator[AsyncDB, None]:
+        return self.default_node.dbs(limit, start_key, end_key)
+
+    async def seed(
+        self,
+        num_dbs: int,
+        docs_per_db: int,
+        batch_size: int = 1000,
+        parallelism: int = 100,
+    ):
+        async def do(i):
+            db = await self.db(f"db-{i}").create()
+            docs = [{"index": j} for j in range(docs_per_db)]
+            async for result in db.insert_many(docs, batch_size=batch_size):
+                if "error" in result:
+                    raise Exception(
+                        f"{db}/{result['id']}: {result['error']} ({result['reason']})"
+                    )
+
+        await async_parallel_iter_with_progress(
+            do,
+            range(num_dbs),
+            parallelism=parallelism,
+            description="creating databases",
+        )
+
+    async def validate_seed(self, num_dbs: int, docs_per_db: int):
+        with progress() as pbar:
+
+            async def do(node: AsyncNode):
+                task = pbar.add_task(str(node.index))
+                await node.validate_seed(num_dbs, docs_per_db, pbar=pbar, task_id=task)
+
+            await asyncio.gather(*(do(node) for node in self.nodes))
+
+    async def wait_for_seed(
+        self, num_dbs: int, docs_per_db: int, timeout: int = 60
+    ) -> dict[AsyncNode, dict[str, datetime]]:
+        start = datetime.now()
+        with status(f"waiting for {len(self.nodes)} nodes to sync"):
+            results = await asyncio.gather(
+                *(n.wait_for_seed(num_dbs, docs_per_db, timeout) for n in self.nodes)
+            )
+        converged = dict(zip(self.nodes, results))
+        print_convergence(start, {n.index: times for n, times in converged.items()})
+        return converged
+
+    async def destroy_seed_data(self, parallelism: int = 100):
+        names = [
+            db.name async for db in self.dbs(start_key="db-", end_key="db-\ufff0")
+        ]
+
+        async def do(name: str):
+            await self.db(name).destroy()
+
+        await async_parallel_iter_with_progress(
+            do, names, parallelism=parallelism, description="destroying databases"
+        )
@@ -0,0 +1,180 @@
+import asyncio
+import threading
+import time
+from base64 import b64encode
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+import requests
+
+from .credentials import password, username
+from .log import logger
+
+# CouchDB's default [chttpd_auth] timeout, used when the session cookie
+# doesn't tell us when it expires.
+DEFAULT_SESSION_TTL = 600
+
+# Refresh the cookie once this fraction of its lifetime has passed, so
+# in-flight requests don't all hit a 401 at the same moment.
+REFRESH_AT = 0.8
+
+# Statuses from POST /_session that mean the node won't do cookie auth.
+COOKIE_REJECTED = (401, 403, 404)
+
+BASIC_AUTH_HEADERS = {
+    "Authorization": "Basic "
+    + b64encode(f"{username}:{password}".encode()).decode()
+}
+
+_auth_mode = "cookie"
+
+
+def set_auth_mode(mode: str):
+    global _auth_mode
+    if mode not in ("cookie", "basic"):
+        raise ValueError(f"unknown auth mode: {mode}")
+    _auth_mode = mode
+
+
+class Auth:
+    """
+    Shared authentication state for a single node.
+
+    Every thread talking to the node goes through the same Auth, so when
+    the session cookie expires only one of them logs in again. The others
+    wait on the lock and then see that the generation has moved on.
+    """
+
+    base_url: str
+    session: requests.Session
+    generation: int
+    refresh_at: float
+    use_basic: bool
+
+    def __init__(self, base_url: str, session: requests.Session):
+        self.base_url = base_url
+        self.session = session
+        self.generation = 0
+        # Nothing to refresh until the first 401 makes us log in.
+        self.refresh_at = float("inf")
+        self.use_basic = _auth_mode == "basic"
+        self._lock = threading.Lock()
+
+    def headers(self) -> dict[str, str]:
+        if self.use_basic:
+            return BASIC_AUTH_HEADERS
+        return {}
+
+    def ensure(self) -> int:
+        """
+        Logs in again if the current cookie is about to expire, and returns
+        the generation the caller's request will be sent with.
+        """
+        generation = self.generation
+        if not self.use_basic and time.monotonic() >= self.refresh_at:
+            self.reauthenticate(generation)
+        return self.generation
+
+    def reauthenticate(self, seen: int):
+        with self._lock:
+            if self.generation != seen:
+                return
+
+            try:
+                resp = self.session.post(
+                    f"{self.base_url}/_session",
+                    json={"name": username, "password": password},
+                    timeout=5,
+                )
+                resp.raise_for_status()
+                ttl = self._cookie_ttl(resp)
+                self.refresh_at = time.monotonic() + ttl * REFRESH_AT
+                logger.debug(f"authenticated with {self.base_url} for {ttl:.0f}s")
+            except requests.exceptions.HTTPError as e:
+                # Only a node that refuses cookie login is switched to basic
+                # auth for good; anything else is left for retries to handle.
+                if e.response is None or e.response.status_code not in COOKIE_REJECTED:
+                    raise
+                logger.debug(
+                    f"cookie auth with {self.base_url} failed ({e}), using basic auth"
+                )
+                self.use_basic = True
+
+            self.generation += 1
+
+    def _cookie_ttl(self, resp: requests.Response) -> float:
+        for cookie in resp.cookies:
+            if cookie.name == "AuthSession" and cookie.expires:
+                return max(0, cookie.expires - time.time())
+        return DEFAULT_SESSION_TTL
+
+
+class AsyncAuth:
+    """
+    The asyncio counterpart of Auth: every coroutine talking to a node goes
+    through the same AsyncAuth, so a burst of 401s leads to one login.
+
+    The lock belongs to the event loop it's first used on, so an AsyncAuth
+    mustn't outlive the AsyncCluster that created it.
+    """
+
+    base_url: str
+    session: aiohttp.ClientSession
+    generation: int
+    refresh_at: float
+    use_basic: bool
+
+    def __init__(self, base_url: str, session: aiohttp.ClientSession):
+        self.base_url = base_url
+        self.session = session
+        self.generation = 0
+        self.refresh_at = float("inf")
+        self.use_basic = _auth_mode == "basic"
+        self._lock = asyncio.Lock()
+
+    def headers(self) -> dict[str, str]:
+        if self.use_basic:
+            return BASIC_AUTH_HEADERS
+        return {}
+
+    async def ensure(self) -> int:
+        generation = self.generation
+        if not self.use_basic and time.monotonic() >= self.refresh_at:
+            await self.reauthenticate(generation)
+        return self.generation
+
+    async def reauthenticate(self, seen: int):
+        async with self._lock:
+            if self.generation != seen:
+                return
+
+            async with self.session.post(
+                f"{self.base_url}/_session",
+                json={"name": username, "password": password},
+                timeout=aiohttp.ClientTimeout(total=5),
+            ) as resp:
+                if resp.status in COOKIE_REJECTED:
+                    logger.debug(
+                        f"cookie auth with {self.base_url} failed ({resp.status}), "
+                        "using basic auth"
+                    )
+                    self.use_basic = True
+                else:
+                    resp.raise_for_status()
+                    ttl = self._cookie_ttl(resp)
+                    self.refresh_at = time.monotonic() + ttl * REFRESH_AT
+                    logger.debug(
+                        f"authenticated with {self.base_url} for {ttl:.0f}s"
+                    )
+
+            self.generation += 1
+
+    def _cookie_ttl(self, resp: aiohttp.ClientResponse) -> float:
+        cookie = resp.cookies.get("AuthSession")
+        if cookie is not None:
+            if cookie["max-age"]:
+                return max(0, float(cookie["max-age"]))
+            if cookie["expires"]:
+                expires = parsedate_to_datetime(cookie["expires"]).timestamp()
+                return max(0, expires - time.time())
+        return DEFAULT_SESSION_TTL
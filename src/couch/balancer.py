@@ -0,0 +1,157 @@
+import itertools
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+import requests
+
+from .log import logger
+
+if TYPE_CHECKING:
+    from .node import Node
+
+
+class NodeState:
+    outstanding: int
+    ewma: float
+    failures: int
+    ejected_until: float
+
+    def __init__(self):
+        self.outstanding = 0
+        self.ewma = 0
+        self.failures = 0
+        self.ejected_until = 0
+
+
+def is_node_failure(e: Exception) -> bool:
+    """
+    Client errors such as 404s and 409s say nothing about the health of the
+    node that returned them, so only count timeouts, connection errors and
+    5xx responses against it.
+    """
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is None or e.response.status_code >= 500
+    return isinstance(e, requests.exceptions.RequestException)
+
+
+class Balancer:
+    max_failures: int
+    ejection_time: float
+
+    def __init__(self, max_failures: int = 3, ejection_time: float = 5):
+        self.max_failures = max_failures
+        self.ejection_time = ejection_time
+        self._states: dict["Node", NodeState] = {}
+        self._lock = threading.Lock()
+
+    def state(self, node: "Node") -> NodeState:
+        if node not in self._states:
+            self._states[node] = NodeState()
+        return self._states[node]
+
+    def pick(self, nodes: list["Node"]) -> "Node":
+        with self._lock:
+            now = time.monotonic()
+            healthy = [n for n in nodes if self.state(n).ejected_until <= now]
+            # If every node has been ejected, we'd rather try one than fail.
+            return self.choose(healthy or nodes)
+
+    def choose(self, nodes: list["Node"]) -> "Node":
+        raise NotImplementedError
+
+    @contextmanager
+    def track(self, node: "Node"):
+        with self._lock:
+            state = self.state(node)
+            state.outstanding += 1
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            with self._lock:
+                state.outstanding -= 1
+                if is_node_failure(e):
+                    self._failure(node, state)
+            raise
+        else:
+            with self._lock:
+                state.outstanding -= 1
+                self._success(node, state, time.monotonic() - start)
+
+    def _failure(self, node: "Node", state: NodeState):
+        state.failures += 1
+        if state.failures >= self.max_failures:
+            if state.ejected_until <= time.monotonic():
+                logger.info(
+                    f"ejecting node:{node.index} after {state.failures} failures"
+                )
+            state.ejected_until = time.monotonic() + self.ejection_time
+
+    def _success(self, node: "Node", state: NodeState, latency: float):
+        if state.failures >= self.max_failures:
+            logger.info(f"re-admitting node:{node.index}")
+        state.failures = 0
+        state.ejected_until = 0
+        self.observe(state, latency)
+
+    def observe(self, state: NodeState, latency: float):
+        pass
+
+
+class RandomBalancer(Balancer):
+    def choose(self, nodes: list["Node"]) -> "Node":
+        return random.choice(nodes)
+
+
+class RoundRobinBalancer(Balancer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._counter = itertools.count()
+
+    def choose(self, nodes: list["Node"]) -> "Node":
+        return nodes[next(self._counter) % len(nodes)]
+
+
+class LeastOutstandingBalancer(Balancer):
+    def choose(self, nodes: list["Node"]) -> "Node":
+        least = min(self.state(n).outstanding for n in nodes)
+        return random.choice([n for n in nodes if self.state(n).outstanding == least])
+
+
+class EWMABalancer(Balancer):
+    """
+    Picks the node with the lowest exponentially weighted moving average
+    latency, scaled by how many requests are already in flight to it.
+    Nodes we haven't heard from yet score zero so they get probed first.
+    """
+
+    alpha: float
+
+    def __init__(self, *args, alpha: float = 0.3, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.alpha = alpha
+
+    def observe(self, state: NodeState, latency: float):
+        if state.ewma == 0:
+            state.ewma = latency
+        else:
+            state.ewma = self.alpha * latency + (1 - self.alpha) * state.ewma
+
+    def score(self, node: "Node") -> float:
+        state = self.state(node)
+        return state.ewma * (state.outstanding + 1)
+
+    def choose(self, nodes: list["Node"]) -> "Node":
+        best = min(self.score(n) for n in nodes)
+        return random.choice([n for n in nodes if self.score(n) == best])
+
+
+BALANCERS: dict[str, type[Balancer]] = {
+    "random": RandomBalancer,
+    "round-robin": RoundRobinBalancer,
+    "least-outstanding": LeastOutstandingBalancer,
+    "ewma": EWMABalancer,
+}
@@ -0,0 +1,312 @@
+import bisect
+import itertools
+import random
+import threading
+import time
+from collections import Counter
+from typing import TYPE_CHECKING, Callable, Generator
+from urllib.parse import quote
+
+import requests
+from utils import bounded_map, process_map
+
+from .http import split_rate_limits
+from .metrics import EndpointStats, Metrics, metrics, metrics_enabled
+
+if TYPE_CHECKING:
+    from .cluster import Cluster
+    from .node import Node
+
+OPERATIONS = ("read", "write", "update", "delete")
+
+
+def parse_mix(spec: str) -> dict[str, float]:
+    """
+    Parses an operation mix such as "read=80,write=10,update=5,delete=5".
+    Weights are relative, so they needn't add up to 100.
+    """
+    mix: dict[str, float] = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"unknown operation: {name}")
+        mix[name] = float(weight)
+    if sum(mix.values()) <= 0:
+        raise ValueError("operation mix needs at least one positive weight")
+    return mix
+
+
+def uniform_keys(n: int) -> Callable[[], int]:
+    return lambda: random.randrange(n)
+
+
+def zipfian_keys(n: int, theta: float = 0.99) -> Callable[[], int]:
+    """
+    Picks key i with probability proportional to 1 / (i + 1) ** theta, so a
+    handful of hot keys get most of the traffic.
+    """
+    cdf = list(itertools.accumulate(1 / (i + 1) ** theta for i in range(n)))
+    total = cdf[-1]
+    return lambda: min(n - 1, bisect.bisect_left(cdf, random.random() * total))
+
+
+KEY_DISTRIBUTIONS: dict[str, Callable[[int], Callable[[], int]]] = {
+    "uniform": uniform_keys,
+    "zipfian": zipfian_keys,
+}
+
+
+def parse_size(spec: str) -> Callable[[], int]:
+    """
+    Parses a document size distribution in bytes: "1024" for a fixed size,
+    "256-4096" for sizes drawn uniformly from a range, or "exp:1024" for
+    exponentially distributed sizes with that mean.
+    """
+    if spec.startswith("exp:"):
+        mean = float(spec.removeprefix("exp:"))
+        return lambda: int(random.expovariate(1 / mean))
+    if "-" in spec:
+        low, high = (int(s) for s in spec.split("-", 1))
+        return lambda: random.randint(low, high)
+    size = int(spec)
+    return lambda: size
+
+
+def until(end: float) -> Generator[None, None, None]:
+    """A closed-loop schedule: start the next request as soon as possible."""
+    while time.monotonic() < end:
+        yield None
+
+
+def arrivals(rate: float, start: float, end: float) -> Generator[float, None, None]:
+    """
+    An open-loop schedule: the intended start time of a request every
+    1 / rate seconds. It sleeps until each one is due, so whatever pulls
+    from it is paced. Latency is measured from the intended start, so time
+    spent waiting for a free client counts against the cluster rather than
+    being silently skipped.
+    """
+    for i in itertools.count():
+        at = start + i / rate
+        if at >= end:
+            return
+        delay = at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        yield at
+
+
+class BenchResult:
+    duration: float
+    ops: dict[str, EndpointStats]
+    nodes: Counter[str]
+
+    def __init__(self, duration: float):
+        self.duration = duration
+        self.ops = {op: EndpointStats() for op in OPERATIONS}
+        self.nodes = Counter()
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        op: str,
+        node: str,
+        latency: float,
+        status: str,
+        sent: int,
+        received: int,
+    ):
+        self.ops[op].record(latency, status, sent, received)
+        with self._lock:
+            self.nodes[node] += 1
+
+    @property
+    def requests(self) -> int:
+        return sum(stats.requests for stats in self.ops.values())
+
+    def throughput(self, requests: int | None = None) -> float:
+        if requests is None:
+            requests = self.requests
+        return requests / self.duration if self.duration else 0
+
+    def merge(self, other: "BenchResult"):
+        for op, stats in other.ops.items():
+            self.ops[op].merge(stats)
+        with self._lock:
+            self.nodes.update(other.nodes)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class Bench:
+    """
+    Runs a mix of reads, writes, updates and deletes against the documents
+    bench-00000000 to bench-{keys - 1} in one database.
+
+    Reads, updates and deletes pick a key from the key distribution, and
+    writes create new documents with server-generated ids. The revision of
+    each key is remembered so that updates and deletes usually succeed;
+    concurrent changes to the same key show up as 409s, as they would for
+    any other client.
+    """
+
+    cluster: "Cluster"
+    db_name: str
+    keys: int
+    mix: dict[str, float]
+
+    def __init__(
+        self,
+        cluster: "Cluster",
+        db_name: str = "bench",
+        keys: int = 10000,
+        mix: dict[str, float] | None = None,
+        distribution: str = "uniform",
+        doc_size: str = "1024",
+    ):
+        self.cluster = cluster
+        self.db_name = db_name
+        self.keys = keys
+        self.mix = mix or {"read": 1}
+        self._choose_key = KEY_DISTRIBUTIONS[distribution](keys)
+        self._doc_size = parse_size(doc_size)
+        self._revs: dict[str, str | None] = {}
+
+    def key(self, i: int) -> str:
+        return f"bench-{i:08d}"
+
+    def doc(self) -> dict[str, str]:
+        # Random hex so that CouchDB's compression doesn't flatter us.
+        return {"data": random.randbytes(self._doc_size() // 2).hex()}
+
+    def prepare(self, batch_size: int = 1000, q: int = 2, n: int = 2):
+        """Creates the database if needed and makes sure every key exists."""
+        db = self.cluster.db(self.db_name)
+        if not db.exists():
+            db.create(q=q, n=n)
+
+        for doc in db.list(start_key="bench-", end_key="bench-\ufff0"):
+            self._revs[doc.id] = doc.rev
+
+        missing = (self.key(i) for i in range(self.keys))
+        docs = ({"_id": key, **self.doc()} for key in missing if key not in self._revs)
+        for result in db.insert_many(docs, batch_size=batch_size):
+            if "error" in result:
+                raise Exception(
+                    f"{db}/{result['id']}: {result['error']} ({result['reason']})"
+                )
+            self._revs[result["id"]] = result["rev"]
+
+    def run(
+        self,
+        duration: float,
+        warmup: float = 0,
+        clients: int = 16,
+        rate: float | None = None,
+        processes: int = 1,
+    ) -> BenchResult:
+        """
+        Runs the workload for warmup + duration seconds and returns what
+        happened after the warmup. Without a rate, each of clients threads
+        sends its next request as soon as the last one returns (closed
+        loop). With a rate, requests start on a fixed schedule whether or
+        not earlier ones have finished (open loop), with at most clients in
+        flight.
+
+        With processes, that many forked processes each run clients
+        threads, the rate is split between them, and their results are
+        merged into one.
+        """
+        if processes > 1:
+            return self._run_processes(duration, warmup, clients, rate, processes)
+
+        start = time.monotonic()
+        measure_from = start + warmup
+        end = measure_from + duration
+        result = BenchResult(duration)
+        ops, weights = zip(*self.mix.items())
+
+        def do(intended: float | None):
+            began = time.monotonic() if intended is None else intended
+            op = random.choices(ops, weights)[0]
+            node = self.cluster.default_node
+            status, sent, received = self._run(op, node)
+            if began >= measure_from:
+                latency = time.monotonic() - began
+                result.record(
+                    op, f"node:{node.index}", latency, status, sent, received
+                )
+
+        schedule = until(end) if rate is None else arrivals(rate, start, end)
+        for _ in bounded_map(
+            do, schedule, parallelism=clients, max_in_flight=clients, ordered=False
+        ):
+            pass
+        return result
+
+    def _run_processes(
+        self,
+        duration: float,
+        warmup: float,
+        clients: int,
+        rate: float | None,
+        processes: int,
+    ) -> BenchResult:
+        def shard(_: int) -> tuple[BenchResult, Metrics]:
+            split_rate_limits(processes)
+            share = rate / processes if rate is not None else None
+            return self.run(duration, warmup, clients, share), metrics
+
+        merged = BenchResult(duration)
+        for result, shard_metrics in process_map(shard, range(processes)):
+            merged.merge(result)
+            if metrics_enabled():
+                metrics.merge(shard_metrics)
+        return merged
+
+    def _run(self, op: str, node: "Node") -> tuple[str, int, int]:
+        key = self.key(self._choose_key())
+        db = quote(self.db_name, safe="")
+        path = f"/{db}/{key}"
+        rev = self._revs.get(key)
+        query = f"?rev={rev}" if rev else ""
+        try:
+            if op == "read":
+                resp = node.get(path, max_attempts=1)
+            elif op == "write":
+                resp = node.post(f"/{db}", json=self.doc(), max_attempts=1)
+            elif op == "update":
+                resp = node.put(f"{path}{query}", json=self.doc(), max_attempts=1)
+                self._revs[key] = resp.json()["rev"]
+            else:
+                resp = node.delete(f"{path}{query}", max_attempts=1)
+                self._revs[key] = None
+        except requests.exceptions.HTTPError as e:
+            if e.response is None:
+                return type(e).__name__, 0, 0
+            resp = e.response
+            if resp.status_code == 409:
+                self._refresh(node, path, key)
+        except requests.exceptions.RequestException as e:
+            return type(e).__name__, 0, 0
+
+        body = resp.request.body
+        sent = len(body) if body is not None else 0
+        return str(resp.status_code), sent, len(resp.content)
+
+    def _refresh(self, node: "Node", path: str, key: str):
+        try:
+            self._revs[key] = node.get(path, max_attempts=1).json()["_rev"]
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                self._revs[key] = None
+        except requests.exceptions.RequestException:
+            pass
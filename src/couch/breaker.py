@@ -0,0 +1,121 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+from .balancer import is_node_failure
+from .log import logger
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+_max_failures = 5
+_open_time: float = 5
+
+
+def set_breaker_options(max_failures: int, open_time: float):
+    """
+    Sets how many consecutive failures open a node's circuit, and how long
+    it stays open before being probed. max_failures of 0 disables breaking.
+    """
+    global _max_failures, _open_time
+    _max_failures = max_failures
+    _open_time = open_time
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a node after max_failures consecutive
+    failures. While open, requests fail straight away. Once open_time has
+    passed, the next request probes the node's /_up endpoint: if that
+    answers the circuit closes again, otherwise it stays open for another
+    open_time. Other requests keep failing fast while the probe is out.
+    """
+
+    base_url: str
+    session: requests.Session
+    max_failures: int
+    open_time: float
+    state: str
+    failures: int
+
+    def __init__(
+        self,
+        base_url: str,
+        session: requests.Session,
+        max_failures: int | None = None,
+        open_time: float | None = None,
+    ):
+        self.base_url = base_url
+        self.session = session
+        self.max_failures = _max_failures if max_failures is None else max_failures
+        self.open_time = _open_time if open_time is None else open_time
+        self.state = CLOSED
+        self.failures = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def check(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN or time.monotonic() < self._open_until:
+                raise CircuitOpenError(f"circuit for {self.base_url} is open")
+            self._transition(HALF_OPEN)
+
+        if self._probe():
+            with self._lock:
+                self.failures = 0
+                self._transition(CLOSED)
+            return
+
+        with self._lock:
+            self._open()
+        raise CircuitOpenError(f"circuit for {self.base_url} is open")
+
+    @contextmanager
+    def guard(self):
+        try:
+            yield
+        except Exception as e:
+            if is_node_failure(e):
+                self.failure()
+            raise
+        else:
+            self.success()
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if (
+                self.state == CLOSED
+                and self.max_failures > 0
+                and self.failures >= self.max_failures
+            ):
+                self._open()
+
+    def _open(self):
+        self._open_until = time.monotonic() + self.open_time
+        self._transition(OPEN)
+
+    def _transition(self, state: str):
+        if state != self.state:
+            logger.info(f"circuit for {self.base_url}: {self.state} -> {state}")
+            self.state = state
+
+    def _probe(self) -> bool:
+        try:
+            resp = self.session.get(f"{self.base_url}/_up", timeout=1)
+            return resp.ok
+        except requests.exceptions.RequestException:
+            return False
@@ -1,32 +1,39 @@
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from random import randint
 from time import sleep
 from typing import Any, Generator, Iterable, cast, override
 
 import click
-import docker
 import requests
 from couch.log import logger
 from docker.models.containers import Container
 from rich.console import Console
-from couch.http import HTTPMixin
+from couch.http import HTTPMixin, split_rate_limits
 from utils import (
     parallel_iter,
     parallel_iter_with_progress,
     parallel_map,
+    process_map,
     progress,
     retry,
     status,
 )
 
+from .balancer import BALANCERS, Balancer
+from .breaker import CircuitOpenError
+from .containers import docker_client
+from .convergence import print_convergence
 from .credentials import password, username
+from .hedge import IDEMPOTENT_METHODS, Hedger
+from .metrics import Metrics, metrics, metrics_enabled
 from .db import DB
 from .node import Node
 from .types import DBInfo, MembershipResponse
 
 _current_cluster = "default"
 _default_node: int | None = None
+_balancer = "random"
+_hedge_percentile: float | None = None
 
 
 def set_current_cluster(name: str):
@@ -44,16 +51,30 @@ def get_default_node() -> int | None:
     return _default_node
 
 
+def set_balancer(name: str):
+    global _balancer
+    if name not in BALANCERS:
+        raise ValueError(f"unknown balancer: {name}")
+    _balancer = name
+
+
+def set_hedge_percentile(percentile: float | None):
+    global _hedge_percentile
+    _hedge_percentile = percentile
+
+
 class Cluster(HTTPMixin):
     name: str
     nodes: list[Node]
+    balancer: Balancer
+    hedger: Hedger | None
 
     @staticmethod
     def init(name: str, num_nodes: int = 3, image: str = "couchdb:3.2.1") -> "Cluster":
         console = Console()
         console.print(f"🚀 creating cluster with name {name}")
 
-        client = docker.from_env()
+        client = docker_client()
 
         if len(client.networks.list(filters={"label": f"cpg={name}"})) != 0:
             console.print(f'❌ cluster with name "{name}" already exists')
@@ -79,20 +100,20 @@ class Cluster(HTTPMixin):
         return cluster
 
     def destroy(self):
-        client = docker.from_env()
+        client = docker_client()
         console = Console()
         filters = {"label": f"cpg={self.name}"}
 
         console.print(f'💥 destroying cluster "{self.name}"')
 
         with status("stopping nodes"):
-            parallel_map(lambda c: c.stop(), client.containers.list(filters=filters))  # type: ignore
+            parallel_iter(lambda c: c.stop(), client.containers.list(filters=filters))  # type: ignore
 
         with status("removing nodes"):
             client.containers.prune(filters=filters)
 
         with status("deleting volumes"):
-            parallel_map(lambda v: v.remove(), client.volumes.list(filters=filters))  # type: ignore
+            parallel_iter(lambda v: v.remove(), client.volumes.list(filters=filters))  # type: ignore
             client.volumes.prune(filters=filters)
 
         with status("deleting network"):
@@ -102,7 +123,7 @@ class Cluster(HTTPMixin):
 
     @staticmethod
     def from_name(name: str) -> "Cluster":
-        client = docker.from_env()
+        client = docker_client()
 
         network = client.networks.list(filters={"label": f"cpg={name}"})
         if len(network) == 0:
@@ -121,6 +142,10 @@ class Cluster(HTTPMixin):
     def __init__(self, name: str, nodes: list[Node]):
         self.name = name
         self.nodes = nodes
+        self.balancer = BALANCERS[_balancer]()
+        self.hedger = None
+        if _hedge_percentile is not None:
+            self.hedger = Hedger(_hedge_percentile)
         self.reorder_nodes()
 
     def reorder_nodes(self):
@@ -135,9 +160,13 @@ class Cluster(HTTPMixin):
     @property
     def default_node(self) -> Node:
         if _default_node is None:
-            return self.nodes[randint(0, len(self.nodes) - 1)]
+            return self.balancer.pick(self.nodes)
         return self.nodes[_default_node]
 
+    @override
+    def cache_key(self) -> str:
+        return f"cluster:{self.name}"
+
     @override
     def request(
         self,
@@ -148,16 +177,54 @@ class Cluster(HTTPMixin):
         initial_wait: float = 1,
         backoff_factor: float = 2,
         timeout: float = 5,
+        stream: bool = False,
     ) -> requests.Response:
-        @retry(max_attempts, initial_wait, backoff_factor)
+        def send(node: Node) -> requests.Response:
+            return node.request(method, path, json, max_attempts=1, timeout=timeout)
+
+        attempts = 0
+
+        # Open circuits are failed over below. Once every node's is open,
+        # backing off would only delay the same error.
+        @retry(
+            max_attempts,
+            initial_wait,
+            backoff_factor,
+            retry_if=lambda e: not isinstance(e, CircuitOpenError),
+        )
         def req() -> requests.Response:
-            return self.default_node.request(
-                method,
-                path,
-                json,
-                max_attempts=1,
-                timeout=timeout,
-            )
+            nonlocal attempts
+            attempts += 1
+            if attempts > 1:
+                metrics.retried(self.cache_key(), method, path)
+            if (
+                self.hedger is not None
+                and _default_node is None
+                and method in IDEMPOTENT_METHODS
+                and not stream
+            ):
+                return self.hedger.run(self.nodes, self.balancer, send)
+
+            remaining = list(self.nodes)
+            if _default_node is not None:
+                remaining = [self.default_node]
+            while True:
+                node = self.balancer.pick(remaining)
+                try:
+                    return node.request(
+                        method,
+                        path,
+                        json,
+                        max_attempts=1,
+                        timeout=timeout,
+                        stream=stream,
+                    )
+                except CircuitOpenError:
+                    # Rejected without touching the network, so try the
+                    # next node straight away.
+                    remaining.remove(node)
+                    if not remaining:
+                        raise
 
         return req()
 
@@ -213,7 +280,7 @@ class Cluster(HTTPMixin):
 
     def is_setup(self) -> bool:
         expected = sorted([n.private_address for n in self.nodes])
-        resp = self.get("/_membership")
+        resp = self.get("/_membership", coalesce=True)
         body = resp.json()
         actual = sorted(body["cluster_nodes"])
         for e, a in zip(expected, actual):
@@ -225,14 +292,33 @@ class Cluster(HTTPMixin):
         return self.default_node.db(name)
 
     def dbs(
-        self, limit: int = 100, start_key: str | None = None, end_key: str | None = None
+        self,
+        limit: int = 100,
+        start_key: str | None = None,
+        end_key: str | None = None,
+        prefetch_pages: int = 1,
+    ) -> Generator[DB, None, None]:
+        return self.default_node.dbs(limit, start_key, end_key, prefetch_pages)
+
+    def scan_dbs(
+        self,
+        partitions: int | None = None,
+        start_key: str | None = None,
+        end_key: str | None = None,
+        ordered: bool = False,
     ) -> Generator[DB, None, None]:
-        return self.default_node.dbs(limit, start_key, end_key)
+        return self.default_node.scan_dbs(
+            partitions or len(self.nodes),
+            start_key,
+            end_key,
+            ordered=ordered,
+            nodes=self.nodes,
+        )
 
     def dbs_info(
-        self, db_names: Iterable[str], page_size: int = 100
+        self, db_names: Iterable[str], page_size: int = 100, depth: int = 2
     ) -> Generator[DBInfo, None, None]:
-        return self.default_node.dbs_info(db_names, page_size)
+        return self.default_node.dbs_info(db_names, page_size, depth)
 
     def config(self) -> dict[str, str]:
         return self.default_node.config()
@@ -244,7 +330,7 @@ class Cluster(HTTPMixin):
         return self.default_node.set_config(section, key, value)
 
     def membership(self) -> MembershipResponse:
-        resp = self.get("/_membership")
+        resp = self.get("/_membership", coalesce=True)
         return resp.json()
 
     def get_node(self, i: int) -> Node | None:
@@ -253,11 +339,11 @@ class Cluster(HTTPMixin):
         return self.nodes[i]
 
     def add_node(
-        self, maintenance_mode: bool = False, image: str = "couchdb:3.2.1"
+        self, maintenance_mode: bool = False, image: str | None = None
     ) -> Node:
+        if image is None:
+            image = self.nodes[0].image
         with status(f"adding new node:{len(self.nodes)} ({image})"):
-            if image is None:
-                image = self.nodes[0].image
             new_node = Node.create(self.name, image=image)
             new_node.reload()
 
@@ -279,11 +365,34 @@ class Cluster(HTTPMixin):
             self.reorder_nodes()
             return new_node
 
-    def seed(self, num_dbs: int, docs_per_db: int):
+    def seed(
+        self,
+        num_dbs: int,
+        docs_per_db: int,
+        batch_size: int = 1000,
+        processes: int = 1,
+    ):
         def do(i):
             db = self.db(f"db-{i}").create()
-            for i in range(docs_per_db):
-                db.insert({"index": i})
+            docs = ({"index": j} for j in range(docs_per_db))
+            for result in db.insert_many(docs, batch_size=batch_size):
+                if "error" in result:
+                    raise Exception(
+                        f"{db}/{result['id']}: {result['error']} ({result['reason']})"
+                    )
+
+        if processes > 1:
+            # Each process takes every processes-th database.
+            def shard(first: int) -> Metrics:
+                split_rate_limits(processes)
+                parallel_iter(do, range(first, num_dbs, processes))
+                return metrics
+
+            with status(f"creating databases in {processes} processes"):
+                for shard_metrics in process_map(shard, range(processes)):
+                    if metrics_enabled():
+                        metrics.merge(shard_metrics)
+            return
 
         parallel_iter_with_progress(
             do,
@@ -291,23 +400,51 @@ class Cluster(HTTPMixin):
             description="creating databases",
         )
 
-    def validate_seed(self, num_dbs: int, docs_per_db: int):
+    def validate_seed(self, num_dbs: int, docs_per_db: int, partitions: int = 1):
         with progress() as pbar:
 
             def do(node: Node):
                 task = pbar.add_task(str(node.index))
-                node.validate_seed(num_dbs, docs_per_db, pbar=pbar, task_id=task)
+                node.validate_seed(
+                    num_dbs, docs_per_db, pbar=pbar, task_id=task, partitions=partitions
+                )
 
             parallel_iter(do, self.nodes)
 
-    def wait_for_seed(self, num_dbs: int, docs_per_db: int, timeout: int = 60):
-        for node in self.nodes:
-            with status(f"waiting for node:{node.index} to sync"):
-                node.wait_for_seed(num_dbs, docs_per_db, timeout)
+    def wait_for_seed(
+        self,
+        num_dbs: int,
+        docs_per_db: int,
+        timeout: int = 60,
+        use_db_updates: bool = False,
+    ) -> dict[Node, dict[str, datetime]]:
+        """
+        Waits for every node to have the seed data, polling them all at
+        once so each database's timestamp is when its node first had it.
+        Returns those timestamps per node and prints a summary.
+        """
+        start = datetime.now()
+
+        def wait(node: Node) -> dict[str, datetime]:
+            return node.wait_for_seed(
+                num_dbs, docs_per_db, timeout, use_db_updates=use_db_updates
+            )
+
+        with status(f"waiting for {len(self.nodes)} nodes to sync"):
+            results = parallel_map(wait, self.nodes, parallelism=len(self.nodes))
+            converged = dict(zip(self.nodes, results))
+
+        for node, times in converged.items():
+            for name, at in sorted(times.items(), key=lambda i: i[1]):
+                logger.debug(
+                    f"node:{node.index} {name} converged after {(at - start).total_seconds():.1f}s"
+                )
+        print_convergence(start, {n.index: times for n, times in converged.items()})
+        return converged
 
     def destroy_seed_data(self):
         parallel_iter_with_progress(
             lambda db: db.destroy(),
-            self.dbs(start_key="db-", end_key="db-\ufff0"),
+            self.scan_dbs(start_key="db-", end_key="db-\ufff0"),
             description="destroying databases",
         )
@@ -0,0 +1,18 @@
+from typing import Callable
+
+import docker
+
+_factory: Callable[[], docker.DockerClient] = docker.from_env
+
+
+def set_docker_client(factory: Callable[[], docker.DockerClient]):
+    """
+    Replaces how Cluster and Node get hold of a Docker client, e.g. with
+    couch.fakedocker to run against fake nodes instead of containers.
+    """
+    global _factory
+    _factory = factory
+
+
+def docker_client() -> docker.DockerClient:
+    return _factory()
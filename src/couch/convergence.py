@@ -0,0 +1,93 @@
+import statistics
+from datetime import datetime
+from typing import TYPE_CHECKING
+from urllib.parse import quote
+
+from rich.console import Console
+
+if TYPE_CHECKING:
+    from .node import Node
+
+
+def seed_db_names(num_dbs: int) -> set[str]:
+    return {f"db-{i}" for i in range(num_dbs)}
+
+
+def print_convergence(start: datetime, converged: dict[int, dict[str, datetime]]):
+    """
+    Prints, for each node index, how long after start its seed databases
+    were seen to converge: the median and the slowest.
+    """
+    console = Console()
+    for index, times in sorted(converged.items()):
+        if not times:
+            continue
+        seconds = [(at - start).total_seconds() for at in times.values()]
+        console.print(
+            f"⏱️  node:{index} {len(seconds)} dbs converged, "
+            f"p50 {statistics.median(seconds):.1f}s, max {max(seconds):.1f}s"
+        )
+
+
+class ConvergenceTracker:
+    """
+    Tracks which seed databases on a node still don't have the expected
+    number of documents. Each poll only re-checks databases that are still
+    pending, and records when each one was first seen to have converged.
+
+    With use_db_updates, a poll only re-checks pending databases that
+    /_db_updates says have changed since the last poll, falling back to
+    checking every pending database each full_check_every polls in case an
+    update was missed.
+    """
+
+    node: "Node"
+    docs_per_db: int
+    pending: set[str]
+    converged: dict[str, datetime]
+    use_db_updates: bool
+    full_check_every: int
+
+    def __init__(
+        self,
+        node: "Node",
+        num_dbs: int,
+        docs_per_db: int,
+        use_db_updates: bool = False,
+        full_check_every: int = 10,
+    ):
+        self.node = node
+        self.docs_per_db = docs_per_db
+        self.pending = seed_db_names(num_dbs)
+        self.converged = {}
+        self.use_db_updates = use_db_updates
+        self.full_check_every = full_check_every
+        self._since = "now"
+        self._polls = 0
+
+    def done(self) -> bool:
+        return not self.pending
+
+    def poll(self):
+        to_check = self.pending
+        if self.use_db_updates:
+            changed = self._db_updates()
+            if self._polls % self.full_check_every != 0:
+                to_check = self.pending & changed
+        self._polls += 1
+
+        if not to_check:
+            return
+
+        for info in self.node.dbs_info(sorted(to_check)):
+            if "error" in info:
+                continue
+            if info["info"]["doc_count"] == self.docs_per_db:
+                self.pending.discard(info["key"])
+                self.converged[info["key"]] = datetime.now()
+
+    def _db_updates(self) -> set[str]:
+        resp = self.node.get(f"/_db_updates?feed=normal&since={quote(self._since)}")
+        body = resp.json()
+        self._since = body["last_seq"]
+        return {result["db_name"] for result in body["results"]}
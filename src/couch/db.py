@@ -1,9 +1,16 @@
-from typing import TYPE_CHECKING, Any
+import builtins
+import functools
+import itertools
+import json
+from typing import TYPE_CHECKING, Any, Callable, Generator, Iterable
+from urllib.parse import quote, urlencode
 
 import requests
-from couch.types import DatabaseResponse
+from couch.types import BulkDocResult, BulkGetResult, Change, DatabaseResponse
+from utils import batched, parallel_chain, parallel_map
 
 from .document import Document
+from .scan import before, key_ranges, range_size, split_range
 
 if TYPE_CHECKING:
     from .node import Node
@@ -31,15 +38,241 @@ class DB:
         resp = self.node.post(f"/{self.name}", json=doc)
         return Document.from_response(self, resp)
 
+    def insert_many(
+        self,
+        docs: Iterable[dict[str, Any]],
+        batch_size: int = 1000,
+        timeout: float = 30,
+    ) -> Generator[BulkDocResult, None, None]:
+        for batch in batched(docs, batch_size):
+            resp = self.node.post(
+                f"/{self.name}/_bulk_docs", json={"docs": batch}, timeout=timeout
+            )
+            for result in resp.json():
+                compact: BulkDocResult = {"id": result["id"]}
+                if "rev" in result:
+                    compact["rev"] = result["rev"]
+                if "error" in result:
+                    compact["error"] = result["error"]
+                    compact["reason"] = result.get("reason", "")
+                yield compact
+
     def count(self) -> int:
         resp = self.node.get(f"/{self.name}")
         body = resp.json()
         return body["doc_count"]
 
-    def list(self) -> list[Document]:
-        resp = self.node.get(f"/{self.name}/_all_docs")
-        body = resp.json()
-        return [Document(self, row["id"], row["value"]["rev"]) for row in body["rows"]]
+    def list(
+        self,
+        page_size: int = 1000,
+        include_docs: bool = False,
+        start_key: str | None = None,
+        end_key: str | None = None,
+    ) -> Generator[Document, None, None]:
+        start_id = start_key
+        while True:
+            url = f"/{self.name}/_all_docs?limit={page_size + 1}"
+            if include_docs:
+                url += "&include_docs=true"
+            if start_id is not None:
+                url += f"&startkey={quote(json.dumps(start_id))}"
+                url += f"&startkey_docid={quote(start_id)}"
+            if end_key is not None:
+                url += f"&endkey={quote(json.dumps(end_key))}"
+
+            # The extra row only says where the next page starts. Read past it
+            # rather than break, so the connection is reused for that page.
+            next_id = None
+            for i, row in enumerate(self.node.stream("GET", url, key="rows")):
+                if i == page_size:
+                    next_id = row["id"]
+                    continue
+                yield Document(self, row["id"], row["value"]["rev"], row.get("doc"))
+
+            if next_id is None:
+                break
+            start_id = next_id
+
+    def scan(
+        self,
+        partitions: int = 4,
+        nodes: builtins.list["Node"] | None = None,
+        ordered: bool = False,
+        include_docs: bool = False,
+        start_key: str | None = None,
+        end_key: str | None = None,
+        page_size: int = 1000,
+    ) -> Generator[Document, None, None]:
+        """
+        Lists documents by splitting the id range into partitions and
+        scanning them concurrently, spread across nodes (this DB's node by
+        default). With ordered, documents come back in id order.
+        """
+        nodes = nodes or [self.node]
+
+        def sample(skip: int) -> str | None:
+            url = f"/{self.name}/_all_docs?limit=1&skip={skip}"
+            if start_key is not None:
+                url += f"&startkey={quote(json.dumps(start_key))}"
+            if end_key is not None:
+                url += f"&endkey={quote(json.dumps(end_key))}"
+            rows = self.node.get(url).json()["rows"]
+            return rows[0]["id"] if rows else None
+
+        boundaries = []
+        if partitions > 1:
+            total = self.count()
+            if start_key is not None or end_key is not None:
+                total = range_size(sample, total)
+            boundaries = split_range(sample, total, partitions)
+        ranges = key_ranges(boundaries, start_key, end_key)
+
+        def source(i: int) -> Iterable[Document]:
+            lo, hi = ranges[i]
+            db = self.on_node(nodes[i % len(nodes)])
+            if i == len(ranges) - 1:
+                return db.list(page_size, include_docs, lo, hi)
+            assert hi is not None
+            return before(db.list(page_size, include_docs, lo, hi), lambda d: d.id, hi)
+
+        yield from parallel_chain(
+            [functools.partial(source, i) for i in range(len(ranges))],
+            ordered=ordered,
+        )
+
+    def get_many(
+        self,
+        ids: Iterable[str | tuple[str, str]],
+        batch_size: int = 100,
+        nodes: builtins.list["Node"] | None = None,
+        parallelism: int = 16,
+    ) -> Generator[BulkGetResult, None, None]:
+        """
+        Fetches many documents through /_bulk_get. Each id is either a doc
+        id, or an (id, rev) pair to fetch a specific revision. Batches are
+        spread across nodes (this DB's node by default) and fetched in
+        parallel, and results come back in the order the ids were given.
+        """
+
+        def fetch(
+            work: tuple["Node", tuple[str | tuple[str, str], ...]]
+        ) -> list[BulkGetResult]:
+            node, batch = work
+            docs = [
+                {"id": i} if isinstance(i, str) else {"id": i[0], "rev": i[1]}
+                for i in batch
+            ]
+            results: list[BulkGetResult] = []
+            for result in node.stream(
+                "POST", f"/{self.name}/_bulk_get", json={"docs": docs}, key="results"
+            ):
+                for doc in result["docs"]:
+                    if "ok" in doc:
+                        body = doc["ok"]
+                        results.append(
+                            {"id": result["id"], "rev": body["_rev"], "doc": body}
+                        )
+                    else:
+                        results.append(
+                            {
+                                "id": result["id"],
+                                "error": doc["error"]["error"],
+                                "reason": doc["error"].get("reason", ""),
+                            }
+                        )
+            return results
+
+        work = zip(itertools.cycle(nodes or [self.node]), batched(ids, batch_size))
+        for results in parallel_map(fetch, work, parallelism=parallelism):
+            yield from results
+
+    def changes(
+        self,
+        feed: str = "normal",
+        since: str = "0",
+        include_docs: bool = False,
+        heartbeat: int = 10000,
+        batch_size: int | None = None,
+        filter: str | None = None,
+        doc_ids: builtins.list[str] | None = None,
+        selector: dict[str, Any] | None = None,
+        on_checkpoint: Callable[[str], None] | None = None,
+    ) -> Generator[Change, None, None]:
+        """
+        Follows the database's _changes feed. "normal" returns what has
+        changed since `since` and stops, "longpoll" and "continuous" keep
+        waiting for new changes until the caller stops iterating. Each
+        change carries its seq, which can be passed back in as `since` to
+        resume. With batch_size, normal and longpoll feeds are fetched that
+        many changes per request.
+
+        For normal and longpoll feeds, on_checkpoint is called with each
+        response's last_seq. With a filter that can be well past the last
+        change yielded, so it's the better place to resume from.
+        """
+        if feed not in ("normal", "longpoll", "continuous"):
+            raise ValueError(f"unknown feed: {feed}")
+
+        params: dict[str, Any] = {"feed": feed}
+        method = "GET"
+        body: dict[str, Any] | None = None
+        if doc_ids is not None:
+            params["filter"] = "_doc_ids"
+            method, body = "POST", {"doc_ids": doc_ids}
+        elif selector is not None:
+            params["filter"] = "_selector"
+            method, body = "POST", {"selector": selector}
+        elif filter is not None:
+            params["filter"] = filter
+        if include_docs:
+            params["include_docs"] = "true"
+        if feed != "normal":
+            params["heartbeat"] = heartbeat
+        if batch_size is not None and feed != "continuous":
+            params["limit"] = batch_size
+
+        # Heartbeats keep the connection busy, so a read that takes much
+        # longer than one means the node has gone away.
+        timeout = heartbeat / 1000 + 5
+
+        if feed == "continuous":
+            url = f"/{self.name}/_changes?{urlencode({**params, 'since': since})}"
+            resp = self.node.request(
+                method, url, json=body, timeout=timeout, stream=True
+            )
+            try:
+                for line in resp.iter_lines():
+                    if not line:
+                        continue
+                    change = json.loads(line)
+                    if "id" not in change:
+                        return
+                    yield change
+            finally:
+                resp.close()
+            return
+
+        while True:
+            url = f"/{self.name}/_changes?{urlencode({**params, 'since': since})}"
+            count = 0
+            trailer: dict[str, Any] = {}
+            for change in self.node.stream(
+                method, url, json=body, key="results", timeout=timeout, trailer=trailer
+            ):
+                count += 1
+                since = change["seq"]
+                yield change
+
+            # A filtered feed can skip every change in a batch, so move on
+            # from where the node stopped looking rather than the last match.
+            if "last_seq" in trailer:
+                since = trailer["last_seq"]
+                if on_checkpoint is not None:
+                    on_checkpoint(since)
+            if feed == "longpoll":
+                continue
+            if batch_size is None or count < batch_size:
+                return
 
     def get(self, id: str) -> Document:
         resp = self.node.get(f"/{self.name}/{id}")
@@ -11,6 +11,7 @@ class Document:
     db: "DB"
     id: str
     rev: str
+    body: dict[str, Any] | None
     node: "Node"
 
     @staticmethod
@@ -18,11 +19,12 @@ class Document:
         body = resp.json()
         return Document(db, body["id"], body["rev"])
 
-    def __init__(self, db: "DB", id: str, rev: str):
+    def __init__(self, db: "DB", id: str, rev: str, body: dict[str, Any] | None = None):
         self.db = db
         self.node = db.node
         self.id = id
         self.rev = rev
+        self.body = body
 
     def __str__(self) -> str:
         return f"{self.db}/{self.id}"
@@ -39,6 +41,6 @@ class Document:
         return Document.from_response(self.db, resp)
 
     def on_node(self, node: "Node") -> "Document":
-        doc = Document(self.db, self.id, self.rev)
+        doc = Document(self.db, self.id, self.rev, self.body)
         doc.node = node
         return doc
@@ -0,0 +1,397 @@
+import bisect
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+class FakeDB:
+    name: str
+    q: int
+    n: int
+    docs: dict[str, dict[str, Any]]
+    update_seq: int
+
+    def __init__(self, name: str, q: int = 2, n: int = 2):
+        self.name = name
+        self.q = q
+        self.n = n
+        self.docs = {}
+        self.update_seq = 0
+
+    def live(self) -> list[str]:
+        return sorted(id for id, doc in self.docs.items() if not doc.get("_deleted"))
+
+    def info(self) -> dict[str, Any]:
+        live = self.live()
+        return {
+            "db_name": self.name,
+            "doc_count": len(live),
+            "doc_del_count": len(self.docs) - len(live),
+            "update_seq": str(self.update_seq),
+            "sizes": {"file": 0, "external": 0, "active": 0},
+            "cluster": {"q": self.q, "n": self.n, "w": 2, "r": 2},
+        }
+
+    def write(self, doc: dict[str, Any]) -> tuple[int, dict[str, Any]]:
+        """Writes doc if its _rev matches, returning a status and result."""
+        id = doc.get("_id") or uuid.uuid4().hex
+        current = self.docs.get(id)
+        if current is None:
+            conflict = bool(doc.get("_rev"))
+        else:
+            live = not current.get("_deleted")
+            conflict = live and doc.get("_rev") != current["_rev"]
+        if conflict:
+            return 409, {"id": id, "error": "conflict", "reason": "Document conflict"}
+
+        generation = int(current["_rev"].split("-")[0]) + 1 if current else 1
+        rev = f"{generation}-{uuid.uuid4().hex}"
+        self.docs[id] = {**doc, "_id": id, "_rev": rev}
+        self.update_seq += 1
+        return 201, {"ok": True, "id": id, "rev": rev}
+
+
+class FakeCluster:
+    """
+    The state that every node of one fake cluster shares. Writes are visible
+    on every node straight away, as if replication were instant.
+    """
+
+    dbs: dict[str, FakeDB]
+    members: set[str]
+    config: dict[str, dict[str, dict[str, str]]]
+
+    def __init__(self):
+        self.dbs = {}
+        self.members = set()
+        self.config = {}
+        self.updates: list[tuple[int, str, str]] = []
+        self.lock = threading.RLock()
+        self._names: list[str] | None = None
+
+    def names(self) -> list[str]:
+        """Database names in order, kept until a database is added or removed."""
+        if self._names is None:
+            self._names = sorted(self.dbs)
+        return self._names
+
+    def add_db(self, db: FakeDB):
+        self.dbs[db.name] = db
+        self._names = None
+
+    def remove_db(self, name: str):
+        del self.dbs[name]
+        self._names = None
+
+    def updated(self, db: str, kind: str):
+        self.updates.append((len(self.updates) + 1, db, kind))
+
+
+class Response(Exception):
+    status: int
+    body: Any
+
+    def __init__(self, status: int, body: Any):
+        self.status = status
+        self.body = body
+
+
+def not_found(reason: str = "missing") -> Response:
+    return Response(404, {"error": "not_found", "reason": reason})
+
+
+class FakeNode:
+    """
+    An in-process HTTP server that answers the subset of the CouchDB API
+    this tool uses, backed by a FakeCluster.
+
+    latency is added to every request, either a fixed number of seconds or
+    a function returning one. error_rate is the fraction of requests that
+    fail with a 500. Both can be changed while the node is running. With
+    require_auth, requests without a session cookie or basic credentials
+    get a 401, as they would from a real node.
+    """
+
+    name: str
+    cluster: FakeCluster
+    latency: float | Callable[[], float]
+    error_rate: float
+    require_auth: bool
+    requests: int
+
+    def __init__(
+        self,
+        name: str,
+        cluster: FakeCluster | None = None,
+        latency: float | Callable[[], float] = 0,
+        error_rate: float = 0,
+        require_auth: bool = True,
+    ):
+        self.name = name
+        self.cluster = cluster or FakeCluster()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.require_auth = require_auth
+        self.requests = 0
+        self._server: ThreadingHTTPServer | None = None
+        self._port = 0
+
+    @property
+    def port(self) -> int:
+        return self._port
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._port}"
+
+    def start(self, port: int | None = None) -> "FakeNode":
+        server = ThreadingHTTPServer(("127.0.0.1", port or self._port), _Handler)
+        server.daemon_threads = True
+        server.node = self  # type: ignore
+        self._server = server
+        self._port = server.server_address[1]
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def running(self) -> bool:
+        return self._server is not None
+
+    def handle(self, method: str, path: str, query: dict[str, str], body: Any) -> Any:
+        self.requests += 1
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency > 0:
+            time.sleep(latency)
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            raise Response(500, {"error": "unknown_error", "reason": "injected"})
+
+        parts = [unquote(p) for p in path.strip("/").split("/") if p]
+        with self.cluster.lock:
+            if not parts:
+                return {"couchdb": "Welcome", "version": "fake"}
+            if parts[0].startswith("_"):
+                return self._system(method, parts, query, body)
+            if len(parts) == 1:
+                return self._db(method, parts[0], query, body)
+            return self._doc(method, parts[0], "/".join(parts[1:]), query, body)
+
+    def _system(self, method: str, parts: list[str], query: dict[str, str], body: Any):
+        endpoint = parts[0]
+        if endpoint == "_up":
+            return {"status": "ok"}
+        if endpoint == "_dbs":
+            return {"doc_count": len(self.cluster.dbs)}
+        if endpoint == "_all_dbs":
+            return _key_range(self.cluster.names(), query)
+        if endpoint == "_dbs_info" and method == "POST":
+            return [
+                {"key": key, "info": self.cluster.dbs[key].info()}
+                if key in self.cluster.dbs
+                else {"key": key, "error": "not_found"}
+                for key in body["keys"]
+            ]
+        if endpoint == "_membership":
+            nodes = sorted(self.cluster.members | {self.name})
+            return {"all_nodes": nodes, "cluster_nodes": nodes}
+        if endpoint == "_cluster_setup":
+            return self._cluster_setup(method, body)
+        if endpoint == "_db_updates":
+            return self._db_updates(query)
+        if parts[:2] == ["_node", "_local"] and len(parts) > 2:
+            if parts[2] == "_config":
+                return self._config(method, parts[3:], body)
+            if parts[2] == "_nodes" and len(parts) == 4:
+                return self._nodes(method, parts[3])
+        raise not_found()
+
+    def _cluster_setup(self, method: str, body: Any):
+        if method == "GET":
+            state = "cluster_finished" if self.cluster.members else "cluster_disabled"
+            return {"state": state}
+        if body.get("action") == "add_node":
+            self.cluster.members.add(f"couchdb@{body['host']}")
+        elif body.get("action") == "finish_cluster":
+            self.cluster.members.add(self.name)
+        return {"ok": True}
+
+    def _db_updates(self, query: dict[str, str]):
+        since = query.get("since", "0")
+        updates = self.cluster.updates
+        start = len(updates) if since == "now" else int(since.split("-")[0])
+        results = [
+            {"db_name": db, "type": kind, "seq": str(seq)}
+            for seq, db, kind in updates[start:]
+        ]
+        return {"results": results, "last_seq": str(len(updates))}
+
+    def _config(self, method: str, path: list[str], body: Any):
+        config = self.cluster.config.setdefault(self.name, {})
+        if method == "GET":
+            if not path:
+                return config
+            section = config.get(path[0], {})
+            if len(path) == 1:
+                return section
+            if path[1] not in section:
+                raise not_found("unknown_config_value")
+            return section[path[1]]
+        if method == "PUT" and len(path) == 2:
+            section = config.setdefault(path[0], {})
+            old = section.get(path[1], "")
+            section[path[1]] = body
+            return old
+        if method == "DELETE" and len(path) == 2:
+            return config.get(path[0], {}).pop(path[1], "")
+        raise not_found()
+
+    def _nodes(self, method: str, name: str):
+        if method == "PUT":
+            self.cluster.members.add(name)
+            return {"ok": True, "id": name, "rev": "1-0"}
+        if name not in self.cluster.members:
+            raise not_found()
+        if method == "DELETE":
+            self.cluster.members.discard(name)
+            return {"ok": True, "id": name, "rev": "2-0"}
+        return {"_id": name, "_rev": "1-0"}
+
+    def _db(self, method: str, name: str, query: dict[str, str], body: Any):
+        dbs = self.cluster.dbs
+        if method == "PUT":
+            if name in dbs:
+                raise Response(412, {"error": "file_exists"})
+            q, n = int(query.get("q", 2)), int(query.get("n", 2))
+            self.cluster.add_db(FakeDB(name, q, n))
+            self.cluster.updated(name, "created")
+            raise Response(201, {"ok": True})
+        if name not in dbs:
+            raise not_found("Database does not exist.")
+        if method == "GET":
+            return dbs[name].info()
+        if method == "DELETE":
+            self.cluster.remove_db(name)
+            self.cluster.updated(name, "deleted")
+            return {"ok": True}
+        if method == "POST":
+            status, result = dbs[name].write(body)
+            self.cluster.updated(name, "updated")
+            raise Response(status, result)
+        raise not_found()
+
+    def _doc(self, method: str, name: str, id: str, query: dict[str, str], body: Any):
+        if name not in self.cluster.dbs:
+            raise not_found("Database does not exist.")
+        db = self.cluster.dbs[name]
+
+        if id == "_bulk_docs" and method == "POST":
+            results = [db.write(doc)[1] for doc in body["docs"]]
+            self.cluster.updated(name, "updated")
+            raise Response(201, results)
+        if id == "_all_docs":
+            return self._all_docs(db, query)
+
+        doc = db.docs.get(id)
+        if method == "GET":
+            if doc is None or doc.get("_deleted"):
+                raise not_found("deleted" if doc else "missing")
+            return doc
+        if method == "PUT":
+            rev = query.get("rev", body.get("_rev"))
+            status, result = db.write({**body, "_id": id, "_rev": rev})
+            self.cluster.updated(name, "updated")
+            raise Response(status, result)
+        if method == "DELETE":
+            if doc is None or doc.get("_deleted"):
+                raise not_found("deleted" if doc else "missing")
+            tombstone = {"_id": id, "_rev": query.get("rev"), "_deleted": True}
+            status, result = db.write(tombstone)
+            self.cluster.updated(name, "updated")
+            raise Response(200 if status == 201 else status, result)
+        raise not_found()
+
+    def _all_docs(self, db: FakeDB, query: dict[str, str]):
+        ids = db.live()
+        if "startkey_docid" in query and "startkey" not in query:
+            query = {**query, "startkey": json.dumps(query["startkey_docid"])}
+        rows = []
+        for id in _key_range(ids, query):
+            rev = db.docs[id]["_rev"]
+            row: dict[str, Any] = {"id": id, "key": id, "value": {"rev": rev}}
+            if query.get("include_docs") == "true":
+                row["doc"] = db.docs[id]
+            rows.append(row)
+        return {"total_rows": len(ids), "offset": 0, "rows": rows}
+
+
+def _key_range(keys: list[str], query: dict[str, str]) -> list[str]:
+    """Applies startkey, endkey (inclusive), skip and limit to sorted keys."""
+    lo, hi = 0, len(keys)
+    if "startkey" in query:
+        lo = bisect.bisect_left(keys, json.loads(query["startkey"]))
+    if "endkey" in query:
+        hi = bisect.bisect_right(keys, json.loads(query["endkey"]))
+    lo += int(query.get("skip", 0))
+    if "limit" in query:
+        hi = min(hi, lo + int(query["limit"]))
+    return keys[lo:hi]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, and without this Nagle's
+    # algorithm holds the body back until the client's delayed ACK.
+    disable_nagle_algorithm = True
+
+    def _dispatch(self):
+        node: FakeNode = self.server.node  # type: ignore
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length) if length else b""
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        cookie = None
+        try:
+            body = json.loads(raw) if raw else None
+            if url.path == "/_session" and self.command == "POST":
+                cookie = f"AuthSession={uuid.uuid4().hex}; Version=1; Path=/; HttpOnly"
+                raise Response(200, {"ok": True, "name": body and body.get("name")})
+            if node.require_auth and not self._authenticated(url.path):
+                raise Response(401, {"error": "unauthorized", "reason": "login"})
+            status, result = 200, node.handle(self.command, url.path, query, body)
+        except Response as r:
+            status, result = r.status, r.body
+        except (KeyError, ValueError, TypeError) as e:
+            status, result = 400, {"error": "bad_request", "reason": str(e)}
+
+        payload = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if cookie is not None:
+            self.send_header("Set-Cookie", cookie)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(payload)
+
+    def _authenticated(self, path: str) -> bool:
+        if path == "/_up":
+            return True
+        auth = self.headers.get("Authorization", "")
+        cookie = self.headers.get("Cookie", "")
+        return auth.startswith("Basic ") or "AuthSession=" in cookie
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _dispatch
+
+    def log_message(self, format: str, *args: Any):
+        pass
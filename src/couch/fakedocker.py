@@ -0,0 +1,228 @@
+import itertools
+from datetime import datetime
+from typing import Any, Iterator
+
+from .containers import set_docker_client
+from .fakecouch import FakeCluster, FakeNode
+
+
+def _matches(labels: dict[str, str], filters: dict[str, Any] | None) -> bool:
+    if not filters or "label" not in filters:
+        return True
+    wanted = filters["label"]
+    for label in [wanted] if isinstance(wanted, str) else wanted:
+        key, _, value = label.partition("=")
+        if key not in labels or (value and labels[key] != value):
+            return False
+    return True
+
+
+def _timestamp() -> str:
+    # Docker reports nanoseconds, which Node.started_at trims back off.
+    return datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f") + "000Z"
+
+
+class FakeImage:
+    tags: list[str]
+
+    def __init__(self, tag: str):
+        self.tags = [tag]
+
+
+class FakeContainer:
+    """A "container" that runs a FakeNode instead of CouchDB."""
+
+    client: "FakeDockerClient"
+    id: str
+    name: str
+    image: FakeImage
+    labels: dict[str, str]
+    node: FakeNode
+    attrs: dict[str, Any]
+
+    def __init__(
+        self,
+        client: "FakeDockerClient",
+        id: str,
+        name: str,
+        image: str,
+        hostname: str,
+        labels: dict[str, str],
+        cluster: FakeCluster,
+    ):
+        self.client = client
+        self.id = id
+        self.name = name
+        self.image = FakeImage(image)
+        self.labels = labels
+        self.node = FakeNode(f"couchdb@{hostname}", cluster, **client.node_options)
+        self.attrs = {"State": {}}
+
+    @property
+    def status(self) -> str:
+        return "running" if self.node.running else "exited"
+
+    @property
+    def ports(self) -> dict[str, list[dict[str, str]]]:
+        return {"5984/tcp": [{"HostIp": "127.0.0.1", "HostPort": str(self.node.port)}]}
+
+    def start(self):
+        self.node.start()
+        self.attrs["State"]["StartedAt"] = _timestamp()
+
+    def stop(self, **kwargs):
+        self.node.stop()
+
+    def restart(self, **kwargs):
+        self.stop()
+        self.start()
+
+    def reload(self):
+        pass
+
+    def remove(self, **kwargs):
+        self.node.stop()
+        self.client.containers.remove(self)
+
+    def logs(self, stream: bool = False, **kwargs) -> Iterator[bytes] | bytes:
+        return iter([]) if stream else b""
+
+
+class FakeContainers:
+    def __init__(self, client: "FakeDockerClient"):
+        self.client = client
+        self._containers: dict[str, FakeContainer] = {}
+        self._ids = itertools.count()
+
+    def run(
+        self,
+        image: str,
+        name: str,
+        hostname: str | None = None,
+        network: str | None = None,
+        labels: dict[str, str] | None = None,
+        **kwargs,
+    ) -> FakeContainer:
+        container = FakeContainer(
+            self.client,
+            f"fake-{next(self._ids)}",
+            name,
+            image,
+            hostname or name,
+            labels or {},
+            self.client.cluster(network or "default"),
+        )
+        container.start()
+        self._containers[name] = container
+        return container
+
+    def get(self, name: str) -> FakeContainer:
+        return self._containers[name]
+
+    def list(
+        self, all: bool = False, filters: dict[str, Any] | None = None
+    ) -> list[FakeContainer]:
+        return [
+            c
+            for c in self._containers.values()
+            if (all or c.status == "running") and _matches(c.labels, filters)
+        ]
+
+    def prune(self, filters: dict[str, Any] | None = None):
+        for c in self.list(all=True, filters=filters):
+            if c.status != "running":
+                self.remove(c)
+
+    def remove(self, container: FakeContainer):
+        self._containers.pop(container.name, None)
+
+
+class FakeVolume:
+    def __init__(self, volumes: "FakeVolumes", name: str, labels: dict[str, str]):
+        self.volumes = volumes
+        self.name = name
+        self.labels = labels
+
+    def remove(self, **kwargs):
+        self.volumes._volumes.pop(self.name, None)
+
+
+class FakeVolumes:
+    def __init__(self):
+        self._volumes: dict[str, FakeVolume] = {}
+
+    def create(self, name: str, labels: dict[str, str] | None = None, **kwargs):
+        self._volumes[name] = FakeVolume(self, name, labels or {})
+        return self._volumes[name]
+
+    def get(self, name: str) -> FakeVolume:
+        return self._volumes[name]
+
+    def list(self, filters: dict[str, Any] | None = None) -> list[FakeVolume]:
+        return [v for v in self._volumes.values() if _matches(v.labels, filters)]
+
+    def prune(self, filters: dict[str, Any] | None = None):
+        for v in self.list(filters):
+            v.remove()
+
+
+class FakeNetwork:
+    def __init__(self, name: str, labels: dict[str, str]):
+        self.name = name
+        self.attrs = {"Labels": labels}
+
+
+class FakeNetworks:
+    def __init__(self, client: "FakeDockerClient"):
+        self.client = client
+        self._networks: dict[str, FakeNetwork] = {}
+
+    def create(self, name: str, labels: dict[str, str] | None = None, **kwargs):
+        self._networks[name] = FakeNetwork(name, labels or {})
+        return self._networks[name]
+
+    def list(self, filters: dict[str, Any] | None = None) -> list[FakeNetwork]:
+        return [
+            n for n in self._networks.values() if _matches(n.attrs["Labels"], filters)
+        ]
+
+    def prune(self, filters: dict[str, Any] | None = None):
+        for n in self.list(filters):
+            self._networks.pop(n.name, None)
+            self.client.clusters.pop(n.name, None)
+
+
+class FakeDockerClient:
+    """
+    Enough of docker.DockerClient for Cluster and Node, where every
+    container is a FakeNode on a local port. Nodes on the same network share
+    a FakeCluster. node_options (latency, error_rate, require_auth) apply
+    to every node created afterwards; to tune a running node, change its
+    container's node directly.
+    """
+
+    node_options: dict[str, Any]
+    clusters: dict[str, FakeCluster]
+
+    def __init__(self, **node_options):
+        self.node_options = node_options
+        self.clusters = {}
+        self.containers = FakeContainers(self)
+        self.volumes = FakeVolumes()
+        self.networks = FakeNetworks(self)
+
+    def cluster(self, network: str) -> FakeCluster:
+        if network not in self.clusters:
+            self.clusters[network] = FakeCluster()
+        return self.clusters[network]
+
+    def close(self):
+        for c in self.containers.list():
+            c.stop()
+
+
+def use_fake_docker(**node_options) -> FakeDockerClient:
+    """Points Cluster and Node at a new FakeDockerClient and returns it."""
+    client = FakeDockerClient(**node_options)
+    set_docker_client(lambda: client)  # type: ignore
+    return client
@@ -0,0 +1,176 @@
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Callable
+
+import requests
+from utils import concurrency
+
+from .http import pool_size
+
+if TYPE_CHECKING:
+    from .balancer import Balancer
+    from .node import Node
+
+IDEMPOTENT_METHODS = ("GET", "HEAD")
+
+# Hedged requests run on their own pool so that a caller already running on
+# a worker thread can't deadlock waiting for a slot.
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def hedge_executor() -> ThreadPoolExecutor:
+    """
+    The pool hedged reads are sent from, made on first use so it's sized by
+    the --concurrency and --pool-size in effect. Each worker, and the main
+    thread, may be waiting on a read and its hedge at once, and a node's
+    connection pool should never be short of threads to fill it.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = max(2 * (concurrency() + 1), pool_size())
+            _executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="hedge"
+            )
+        return _executor
+
+
+def _stop_executor():
+    # As with the shared pool (see utils._stop_executor), don't fork with
+    # live hedge threads around.
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+def _reset_executor():
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
+os.register_at_fork(before=_stop_executor, after_in_child=_reset_executor)
+
+
+class HedgeStats:
+    requests: int
+    fired: int
+    won: int
+
+    def __init__(self):
+        self.requests = 0
+        self.fired = 0
+        self.won = 0
+        self._lock = threading.Lock()
+
+    def incr(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+stats = HedgeStats()
+
+
+class Hedger:
+    """
+    Sends a read to one node and, if it hasn't answered by the given
+    percentile of recently observed latencies, sends the same read to a
+    different node. Whichever response arrives first wins.
+    """
+
+    percentile: float
+    initial_delay: float
+    min_samples: int
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        initial_delay: float = 0.5,
+        min_samples: int = 20,
+        window: int = 1024,
+    ):
+        if not 0 < percentile <= 100:
+            raise ValueError(f"hedge percentile must be in (0, 100]: {percentile}")
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def delay(self) -> float:
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return self.initial_delay
+            latencies = sorted(self._latencies)
+        i = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return latencies[i]
+
+    def record(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def _record_primary(self, future: Future[requests.Response], start: float):
+        if not future.cancelled() and future.exception() is None:
+            self.record(time.monotonic() - start)
+
+    def _submit(
+        self, send: Callable[["Node"], requests.Response], node: "Node"
+    ) -> Future[requests.Response]:
+        # Carry the caller's context, such as its retry policy, to the pool.
+        return hedge_executor().submit(contextvars.copy_context().run, send, node)
+
+    def run(
+        self,
+        nodes: list["Node"],
+        balancer: "Balancer",
+        send: Callable[["Node"], requests.Response],
+    ) -> requests.Response:
+        stats.incr("requests")
+        start = time.monotonic()
+        primary = balancer.pick(nodes)
+        first = self._submit(send, primary)
+        # The delay is a percentile of how long first attempts take, so the
+        # primary's latency counts even when a hedge beats it. Only recording
+        # winners would leave out the slow tail and keep shrinking the delay.
+        first.add_done_callback(lambda f: self._record_primary(f, start))
+        # Maps each in-flight request to whether it's the hedge.
+        futures: dict[Future[requests.Response], bool] = {first: False}
+
+        # A primary that fails fast, e.g. on an open circuit, is hedged
+        # straight away rather than failing the read.
+        done, _ = wait(futures, timeout=self.delay())
+        if not done or first.exception() is not None:
+            others = [n for n in nodes if n != primary]
+            if others:
+                stats.incr("fired")
+                futures[self._submit(send, balancer.pick(others))] = True
+
+        error: Exception | None = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    resp = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+
+                # requests can't abort a call that's already on the wire, so
+                # the loser is only cancelled if it hasn't started yet. Its
+                # result is dropped either way.
+                for other in pending:
+                    other.cancel()
+                if futures[future]:
+                    stats.incr("won")
+                return resp
+
+        assert error is not None
+        raise error
@@ -1,15 +1,380 @@
+import codecs
+import json as json_module
+import os
+import re
+import threading
+import time
+from contextlib import AbstractContextManager, nullcontext
+from typing import Any, Callable, Generator, Iterable
+
 import requests
-from couch.credentials import password, username
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+from couch.auth import Auth
+from couch.breaker import CircuitBreaker, CircuitOpenError
 from couch.log import logger
-from utils import retry
+from couch.metrics import Sample, metrics, metrics_enabled
+from utils import RateLimiter, SingleFlight, retry
+
+_pool_size = 32
+_pool_block = False
+
+
+def set_pool_options(size: int, block: bool):
+    global _pool_size, _pool_block
+    _pool_size = size
+    _pool_block = block
+
+
+def pool_size() -> int:
+    return _pool_size
+
+
+_rate: float | None = None
+_node_rate: float | None = None
+_burst = 1
+_global_limiter: RateLimiter | None = None
+_node_limiters: dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def set_rate_limits(
+    rate: float | None = None,
+    burst: int | None = None,
+    node_rate: float | None = None,
+):
+    """
+    Caps requests per second across all nodes (rate) and to each node
+    (node_rate). Only the limits passed in are changed.
+    """
+    global _rate, _node_rate, _burst, _global_limiter
+    with _limiters_lock:
+        if rate is not None:
+            _rate = rate
+        if node_rate is not None:
+            _node_rate = node_rate
+        if burst is not None:
+            _burst = burst
+        _global_limiter = None
+        _node_limiters.clear()
+
+
+def split_rate_limits(n: int):
+    """Divides the configured limits evenly between n processes."""
+    set_rate_limits(
+        rate=_rate / n if _rate is not None else None,
+        node_rate=_node_rate / n if _node_rate is not None else None,
+    )
+
+
+def rate_limiters(base_url: str) -> list[RateLimiter]:
+    global _global_limiter
+    with _limiters_lock:
+        limiters = []
+        if _rate is not None:
+            if _global_limiter is None:
+                _global_limiter = RateLimiter(_rate, _burst)
+            limiters.append(_global_limiter)
+        if _node_rate is not None:
+            if base_url not in _node_limiters:
+                _node_limiters[base_url] = RateLimiter(_node_rate, _burst)
+            limiters.append(_node_limiters[base_url])
+        return limiters
+
+
+class PoolStats:
+    """
+    Connection counters for a single node's pool. "reused" is derived from
+    how many times a connection was checked out of the pool without having
+    to open a new socket.
+    """
+
+    opened: int
+    checkouts: int
+    discarded: int
+
+    def __init__(self):
+        self.opened = 0
+        self.checkouts = 0
+        self.discarded = 0
+        self._lock = threading.Lock()
+
+    def incr(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @property
+    def reused(self) -> int:
+        return max(0, self.checkouts - self.opened)
+
+
+def _counting_pool(stats: PoolStats) -> type[HTTPConnectionPool]:
+    class CountingHTTPConnection(HTTPConnection):
+        def connect(self):
+            stats.incr("opened")
+            super().connect()
+
+    class CountingHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = CountingHTTPConnection
+
+        def _get_conn(self, timeout=None):
+            stats.incr("checkouts")
+            return super()._get_conn(timeout)
+
+        def _put_conn(self, conn):
+            if conn is not None and self.pool is not None and self.pool.full():
+                stats.incr("discarded")
+            super()._put_conn(conn)
+
+    return CountingHTTPConnectionPool
+
+
+_sessions: dict[str, requests.Session] = {}
+_stats: dict[str, PoolStats] = {}
+_auths: dict[str, Auth] = {}
+_breakers: dict[str, CircuitBreaker] = {}
+_sessions_lock = threading.Lock()
+
+
+def _connect(base_url: str):
+    with _sessions_lock:
+        if base_url in _sessions:
+            return
+        stats = PoolStats()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=_pool_size, pool_block=_pool_block
+        )
+        adapter.poolmanager.pool_classes_by_scheme = {
+            **adapter.poolmanager.pool_classes_by_scheme,
+            "http": _counting_pool(stats),
+        }
+        session = requests.Session()
+        session.mount("http://", adapter)
+        _stats[base_url] = stats
+        _auths[base_url] = Auth(base_url, session)
+        _breakers[base_url] = CircuitBreaker(base_url, session)
+        _sessions[base_url] = session
+
+
+def session_for(base_url: str) -> requests.Session:
+    _connect(base_url)
+    return _sessions[base_url]
+
+
+def auth_for(base_url: str) -> Auth:
+    _connect(base_url)
+    return _auths[base_url]
+
+
+def breaker_for(base_url: str) -> CircuitBreaker:
+    _connect(base_url)
+    return _breakers[base_url]
+
+
+def pool_stats() -> dict[str, PoolStats]:
+    with _sessions_lock:
+        return dict(_stats)
+
+
+# Cluster metadata that polling loops ask for over and over, and that only
+# changes when we change it ourselves.
+METADATA_PATHS = ("/_membership", "/_node/_local/_config")
+
+# Writes that can change that metadata: config, membership and cluster setup.
+METADATA_WRITES = re.compile(r"^/(_node/[^/]+/_(config|nodes)|_nodes|_cluster_setup)\b")
+
+_metadata_ttl: float = 1
+_metadata: dict[tuple[str, str], tuple[float, requests.Response]] = {}
+_metadata_generation = 0
+_metadata_lock = threading.Lock()
+_inflight: SingleFlight[tuple[str, str], requests.Response] = SingleFlight()
+
+
+def set_metadata_ttl(ttl: float):
+    global _metadata_ttl
+    _metadata_ttl = ttl
+    invalidate_metadata()
+
 
-session = requests.Session()
+def invalidate_metadata():
+    global _metadata_generation
+    with _metadata_lock:
+        _metadata.clear()
+        _metadata_generation += 1
+
+
+def _coalesced_get(
+    key: tuple[str, str], fetch: Callable[[], requests.Response]
+) -> requests.Response:
+    """
+    Shares one in-flight GET between every caller asking for the same key,
+    and keeps metadata responses around for a short while. A response that
+    was in flight when the metadata was invalidated isn't cached.
+    """
+    if _metadata_ttl <= 0 or not key[1].startswith(METADATA_PATHS):
+        return _inflight.do(key, fetch)
+
+    with _metadata_lock:
+        cached = _metadata.get(key)
+        generation = _metadata_generation
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+
+    resp = _inflight.do(key, fetch)
+    with _metadata_lock:
+        if generation == _metadata_generation:
+            _metadata[key] = (time.monotonic() + _metadata_ttl, resp)
+    return resp
+
+
+def _reset_after_fork():
+    # A forked child mustn't share sockets with its parent, and any lock
+    # held by another thread at the time of the fork would never be freed.
+    global _sessions_lock, _limiters_lock, _metadata_lock, _inflight
+    global _global_limiter
+    _sessions_lock = threading.Lock()
+    _limiters_lock = threading.Lock()
+    _metadata_lock = threading.Lock()
+    _inflight = SingleFlight()
+    _global_limiter = None
+    for registry in (_sessions, _stats, _auths, _breakers, _node_limiters, _metadata):
+        registry.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+_decoder = json_module.JSONDecoder()
+_whitespace = re.compile(r"[\s,]*")
+# What can follow a complete array element.
+_delimiters = frozenset(",] \t\r\n")
+
+
+def iter_json_array(
+    chunks: Iterable[bytes],
+    key: str | None = None,
+    trailer: dict[str, Any] | None = None,
+) -> Generator[Any, None, None]:
+    """
+    Incrementally decodes the elements of a JSON array from a stream of
+    bytes. This only understands the response shapes CouchDB uses: either
+    a bare array, or an object whose array lives under key and comes after
+    any scalar fields (e.g. total_rows and offset in _all_docs).
+
+    If trailer is given, the rest of the body is read once the array ends
+    and the object's fields after it (e.g. last_seq in _changes) are put in
+    trailer.
+    """
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    start = re.compile(r"\[" if key is None else rf'"{re.escape(key)}"\s*:\s*\[')
+    buf = ""
+    pos = 0
+    done = False
+
+    def more() -> bool:
+        nonlocal buf, pos, done
+        if done:
+            return False
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            done = True
+            buf = buf[pos:] + utf8.decode(b"", final=True)
+            pos = 0
+            return True
+        buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+        return True
+
+    while (match := start.search(buf, pos)) is None:
+        if not more():
+            raise ValueError("response did not contain the expected JSON array")
+    pos = match.end()
+
+    while True:
+        pos = _whitespace.match(buf, pos).end()  # type: ignore
+        if pos < len(buf) and buf[pos] == "]":
+            if trailer is not None and key is not None:
+                pos += 1
+                while more():
+                    pass
+                trailer.update(json_module.loads("{" + buf[pos:].lstrip(", \t\r\n")))
+            return
+        try:
+            value, end = _decoder.raw_decode(buf, pos)
+        except json_module.JSONDecodeError:
+            end = None
+        # Objects, arrays and strings end with their own closing character,
+        # but a number or literal is only known to be complete once the
+        # delimiter after it has arrived: "-15" might be the start of
+        # "-15.0", and the decoder would happily stop short at the ".".
+        if end is None or (
+            not done
+            and buf[pos] not in '{["'
+            and (end == len(buf) or buf[end] not in _delimiters)
+        ):
+            if not more():
+                raise ValueError("response ended in the middle of a JSON array")
+            continue
+        yield value
+        pos = end
+
+
+def _sizes(resp: requests.Response, stream: bool) -> tuple[int, int]:
+    body = resp.request.body
+    sent = len(body) if body is not None else 0
+    # Reading a streamed body here would defeat streaming, so it's counted
+    # as it's read instead (see _record_streamed).
+    received = 0 if stream else len(resp.content)
+    return sent, received
+
+
+def _record_streamed(resp: requests.Response, sample: Sample):
+    """
+    Holds a streamed response's sample open while its body is read, so that
+    the latency covers the whole body and its bytes are counted as they
+    arrive. The sample is recorded after the last chunk, or when the caller
+    closes the response early.
+    """
+    sample.defer()
+    iter_content = resp.iter_content
+    close = resp.close
+
+    def counting(*args, **kwargs) -> Generator[Any, None, None]:
+        for chunk in iter_content(*args, **kwargs):
+            sample.received += len(chunk)
+            yield chunk
+        sample.finish()
+
+    def closing():
+        close()
+        sample.finish()
+
+    # iter_lines and __exit__ go through these too.
+    resp.iter_content = counting  # type: ignore
+    resp.close = closing  # type: ignore
 
 
 class HTTPMixin:
     def base_url(self) -> str:
         raise NotImplementedError
 
+    def session(self) -> requests.Session:
+        return session_for(self.base_url())
+
+    def auth(self) -> Auth:
+        return auth_for(self.base_url())
+
+    def breaker(self) -> CircuitBreaker:
+        return breaker_for(self.base_url())
+
+    def cache_key(self) -> str:
+        return self.base_url()
+
+    def track(self) -> AbstractContextManager:
+        return nullcontext()
+
     def request(
         self,
         method: str,
@@ -19,27 +384,96 @@ class HTTPMixin:
         initial_wait: float = 1,
         backoff_factor: float = 2,
         timeout: float = 5,
+        stream: bool = False,
     ) -> requests.Response:
-        url = f"{self.base_url()}{path}"
+        base_url = self.base_url()
+        url = f"{base_url}{path}"
+        session = self.session()
+        auth = self.auth()
+        breaker = self.breaker()
+
+        def send() -> requests.Response:
+            return session.request(
+                method,
+                url,
+                json=json,
+                timeout=timeout,
+                headers=auth.headers(),
+                stream=stream,
+            )
+
+        limiters = rate_limiters(base_url)
+        attempts = 0
 
-        @retry(max_attempts, initial_wait, backoff_factor)
+        # Retrying against an open circuit would only wait out the backoff.
+        @retry(
+            max_attempts,
+            initial_wait,
+            backoff_factor,
+            retry_if=lambda e: not isinstance(e, CircuitOpenError),
+        )
         def req():
-            resp = session.request(method, url, json=json, timeout=timeout)
-            if resp.status_code == 401:
-                resp = session.post(
-                    f"{self.base_url()}/_session",
-                    json={"name": username, "password": password},
-                    timeout=5,
-                )
-                resp.raise_for_status()
-                resp = session.request(method, url, json=json, timeout=timeout)
-            logger.debug(f"{method} {url} {resp.status_code}")
-            if not resp.ok:
-                logger.debug(resp.text)
-            resp.raise_for_status()
-            return resp
-
-        return req()
+            nonlocal attempts
+            attempts += 1
+            if attempts > 1:
+                metrics.retried(base_url, method, path)
+            # An open circuit counts as a failure of the node, so that the
+            # balancer ejects it rather than picking it again.
+            with self.track():
+                breaker.check()
+                for limiter in limiters:
+                    limiter.acquire()
+                with (
+                    breaker.guard(),
+                    metrics.measure(base_url, method, path) as sample,
+                ):
+                    generation = auth.ensure()
+                    resp = send()
+                    if resp.status_code == 401:
+                        resp.close()
+                        auth.reauthenticate(generation)
+                        resp = send()
+                    if metrics_enabled():
+                        sample.response(resp.status_code, *_sizes(resp, stream))
+                        if stream and resp.ok:
+                            _record_streamed(resp, sample)
+                    logger.debug(f"{method} {url} {resp.status_code}")
+                    if not resp.ok:
+                        logger.debug(resp.text)
+                    resp.raise_for_status()
+                    return resp
+
+        resp = req()
+        if method not in ("GET", "HEAD") and METADATA_WRITES.match(path):
+            invalidate_metadata()
+        return resp
+
+    def stream(
+        self,
+        method: str,
+        path: str,
+        json: dict | None = None,
+        key: str | None = None,
+        timeout: float = 30,
+        trailer: dict[str, Any] | None = None,
+    ) -> Generator[Any, None, None]:
+        """
+        Yields the elements of a JSON array in the response body as they
+        arrive, rather than waiting for the whole body. If key is given, the
+        array is taken from that field of the top-level object, e.g. "rows"
+        for _all_docs, and trailer (if given) gets the fields after it.
+        """
+        resp = self.request(method, path, json=json, timeout=timeout, stream=True)
+        chunks = resp.iter_content(chunk_size=64 * 1024)
+        try:
+            yield from iter_json_array(chunks, key, trailer)
+            # The array ends before the body does (a closing brace, the last
+            # chunk). Read the rest so urllib3 can put the connection back in
+            # the pool instead of discarding it.
+            for _ in chunks:
+                pass
+        finally:
+            resp.close()
 
     def get(
         self,
@@ -48,16 +482,27 @@ class HTTPMixin:
         initial_wait: float = 1,
         backoff_factor: float = 2,
         timeout: float = 5,
+        coalesce: bool = False,
     ) -> requests.Response:
-        return self.request(
-            "GET",
-            path,
-            json=None,
-            max_attempts=max_attempts,
-            initial_wait=initial_wait,
-            backoff_factor=backoff_factor,
-            timeout=timeout,
-        )
+        """
+        With coalesce, concurrent GETs of the same path share one request,
+        and metadata (see METADATA_PATHS) is cached for a moment.
+        """
+
+        def fetch() -> requests.Response:
+            return self.request(
+                "GET",
+                path,
+                json=None,
+                max_attempts=max_attempts,
+                initial_wait=initial_wait,
+                backoff_factor=backoff_factor,
+                timeout=timeout,
+            )
+
+        if not coalesce:
+            return fetch()
+        return _coalesced_get((self.cache_key(), path), fetch)
 
     def post(
         self,
@@ -0,0 +1,282 @@
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Generator
+
+_enabled = False
+
+
+def enable_metrics():
+    global _enabled
+    _enabled = True
+
+
+def metrics_enabled() -> bool:
+    return _enabled
+
+
+class Histogram:
+    """
+    An HDR-style histogram of non-negative integers. Values below
+    2**precision are counted exactly; above that, each power of two is split
+    into 2**(precision - 1) equal buckets, so a reported value is within
+    2**-(precision - 1) of the one recorded, relative to its size.
+    Histograms with the same precision can be merged, e.g. across threads
+    or processes.
+    """
+
+    precision: int
+    count: int
+    total: int
+    min: int
+    max: int
+
+    def __init__(self, precision: int = 8):
+        self.precision = precision
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+        self.counts: Counter[int] = Counter()
+
+    def _index(self, value: int) -> int:
+        shift = max(0, value.bit_length() - self.precision)
+        return (shift << self.precision) | (value >> shift)
+
+    def _value(self, index: int) -> int:
+        shift = index >> self.precision
+        top = index & ((1 << self.precision) - 1)
+        # The middle of the bucket.
+        return (top << shift) + ((1 << shift) >> 1)
+
+    def record(self, value: int):
+        value = max(0, value)
+        self.counts[self._index(value)] += 1
+        if self.count == 0 or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.count += 1
+        self.total += value
+
+    def merge(self, other: "Histogram"):
+        if other.precision != self.precision:
+            raise ValueError("can't merge histograms of different precision")
+        if other.count == 0:
+            return
+        if self.count == 0 or other.min < self.min:
+            self.min = other.min
+        self.max = max(self.max, other.max)
+        self.count += other.count
+        self.total += other.total
+        self.counts.update(other.counts)
+
+    def percentile(self, p: float) -> int:
+        if self.count == 0:
+            return 0
+        rank = max(1, round(self.count * p / 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.max, max(self.min, self._value(index)))
+        return self.max
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0
+
+
+class EndpointStats:
+    """Everything recorded about one endpoint on one node. Latencies are µs."""
+
+    latency: Histogram
+    requests: int
+    retries: int
+    bytes_sent: int
+    bytes_received: int
+    statuses: Counter[str]
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.requests = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.statuses = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def errors(self) -> int:
+        return sum(n for s, n in self.statuses.items() if not s.startswith(("2", "3")))
+
+    def record(self, latency: float, status: str, sent: int, received: int):
+        with self._lock:
+            self.latency.record(int(latency * 1_000_000))
+            self.requests += 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+            self.statuses[status] += 1
+
+    def retried(self):
+        with self._lock:
+            self.retries += 1
+
+    def merge(self, other: "EndpointStats"):
+        with self._lock:
+            self.latency.merge(other.latency)
+            self.requests += other.requests
+            self.retries += other.retries
+            self.bytes_sent += other.bytes_sent
+            self.bytes_received += other.bytes_received
+            self.statuses.update(other.statuses)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def path_template(method: str, path: str) -> str:
+    """
+    Turns a request path into the endpoint it hits, e.g.
+    "POST /db-1/_bulk_docs?w=3" into "POST /{db}/_bulk_docs", so that
+    requests to different databases and documents are counted together.
+    """
+    parts = path.split("?", 1)[0].strip("/").split("/")
+    system = parts[0].startswith("_")
+    template = []
+    for i, part in enumerate(parts):
+        if not part or part.startswith("_"):
+            template.append(part)
+        elif i == 0:
+            template.append("{db}")
+        elif system:
+            template.append("{key}")
+        else:
+            template.append("{doc}")
+    return f"{method} /{'/'.join(template)}"
+
+
+class Sample:
+    status: str
+    sent: int
+    received: int
+
+    def __init__(self):
+        self.status = ""
+        self.sent = 0
+        self.received = 0
+        self._deferred = False
+        self._record: Callable[[], None] | None = None
+
+    def response(self, status: int, sent: int, received: int):
+        self.status = str(status)
+        self.sent = sent
+        self.received = received
+
+    def defer(self):
+        """
+        Leaves the sample open when the with block exits, e.g. because the
+        body is still being streamed, until finish() is called.
+        """
+        self._deferred = True
+
+    def finish(self):
+        record, self._record = self._record, None
+        if record is not None:
+            record()
+
+
+class Metrics:
+    def __init__(self):
+        self._endpoints: dict[tuple[str, str], EndpointStats] = {}
+        self._lock = threading.Lock()
+
+    def endpoint(self, node: str, endpoint: str) -> EndpointStats:
+        key = (node, endpoint)
+        with self._lock:
+            if key not in self._endpoints:
+                self._endpoints[key] = EndpointStats()
+            return self._endpoints[key]
+
+    @contextmanager
+    def measure(
+        self, node: str, method: str, path: str
+    ) -> Generator[Sample, None, None]:
+        """
+        Times the body of the with block as one request. The block should
+        call sample.response() once it has a response; if it raises
+        instead, the exception's name is recorded as the status. A block
+        that calls sample.defer() is recorded when sample.finish() is
+        called instead.
+        """
+        sample = Sample()
+        if not _enabled:
+            yield sample
+            return
+        start = time.perf_counter()
+
+        def record():
+            latency = time.perf_counter() - start
+            self.endpoint(node, path_template(method, path)).record(
+                latency, sample.status, sample.sent, sample.received
+            )
+
+        failed = True
+        try:
+            yield sample
+            failed = False
+        except Exception as e:
+            if not sample.status:
+                sample.status = type(e).__name__
+            raise
+        finally:
+            if sample._deferred and not failed:
+                sample._record = record
+            else:
+                record()
+
+    def reset(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def retried(self, node: str, method: str, path: str):
+        if _enabled:
+            self.endpoint(node, path_template(method, path)).retried()
+
+    def items(self) -> list[tuple[tuple[str, str], EndpointStats]]:
+        with self._lock:
+            return sorted(self._endpoints.items())
+
+    def totals(self) -> tuple[int, int]:
+        """Requests and errors across every endpoint so far."""
+        endpoints = [stats for _, stats in self.items()]
+        return sum(s.requests for s in endpoints), sum(s.errors for s in endpoints)
+
+    def merge(self, other: "Metrics"):
+        for (node, endpoint), stats in other.items():
+            self.endpoint(node, endpoint).merge(stats)
+
+    def __getstate__(self):
+        return {"endpoints": dict(self.items())}
+
+    def __setstate__(self, state):
+        self._endpoints = state["endpoints"]
+        self._lock = threading.Lock()
+
+
+metrics = Metrics()
+
+
+def _reset_after_fork():
+    # A forked child reports only what it did itself, for its parent to merge.
+    metrics.reset()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
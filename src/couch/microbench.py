@@ -0,0 +1,252 @@
+import json
+import multiprocessing
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+from multiprocessing.connection import Connection
+from typing import Any, Callable
+
+import requests
+from utils import batched, parallel_iter_with_progress
+
+from .document import Document
+from .fakecouch import FakeDB, FakeNode
+from .node import Node
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+PAGE_SIZE = 100
+MIN_TIME = 0.2
+
+
+class _Remote:
+    """Stands in for a container, pointing a Node at a server by port."""
+
+    def __init__(self, name: str, port: int):
+        self.name = name
+        self.ports = {"5984/tcp": [{"HostIp": "127.0.0.1", "HostPort": str(port)}]}
+
+
+class FakeServer:
+    """
+    A FakeNode holding num_dbs seeded databases, run in a forked process so
+    that its CPU time and memory don't count against the client's.
+    """
+
+    num_dbs: int
+    node: Node
+
+    def __init__(self, num_dbs: int):
+        self.num_dbs = num_dbs
+        ctx = multiprocessing.get_context("fork")
+        self._conn, child = ctx.Pipe()
+        self._process = ctx.Process(target=_serve, args=(num_dbs, child), daemon=True)
+
+    def __enter__(self) -> "FakeServer":
+        self._process.start()
+        port = self._conn.recv()
+        self.node = Node(0, _Remote("microbench", port))  # type: ignore
+        return self
+
+    def __exit__(self, *exc):
+        self._conn.send("stop")
+        self._process.join()
+
+    def requests(self) -> int:
+        self._conn.send("requests")
+        return self._conn.recv()
+
+
+def _serve(num_dbs: int, conn: Connection):
+    node = FakeNode("couchdb@microbench")
+    for i in range(num_dbs):
+        db = FakeDB(f"db-{i}")
+        db.write({"_id": "doc"})
+        node.cluster.add_db(db)
+    conn.send(node.start().port)
+    while conn.recv() != "stop":
+        conn.send(node.requests)
+    node.stop()
+
+
+def bench_validate_seed(server: FakeServer) -> int:
+    server.node.validate_seed(server.num_dbs, 1)
+    return server.num_dbs
+
+
+def bench_dbs(server: FakeServer) -> int:
+    return sum(1 for _ in server.node.dbs(page_size=PAGE_SIZE))
+
+
+def bench_parallel_iter(server: FakeServer) -> int:
+    # A no-op per item, so all that's measured is the pool and progress bar.
+    parallel_iter_with_progress(
+        lambda _: None, range(server.num_dbs), description="parallel_iter"
+    )
+    return server.num_dbs
+
+
+def bench_batched(server: FakeServer) -> int:
+    for _ in batched(range(server.num_dbs), PAGE_SIZE):
+        pass
+    return server.num_dbs
+
+
+def bench_from_response(server: FakeServer) -> int:
+    resp = requests.Response()
+    resp.status_code = 201
+    resp.headers["Content-Type"] = "application/json"
+    resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+    resp._content = json.dumps({"ok": True, "id": "doc", "rev": "1-abc"}).encode()
+    db = server.node.db("db-0")
+    for _ in range(server.num_dbs):
+        Document.from_response(db, resp)
+    return server.num_dbs
+
+
+CASES: dict[str, Callable[[FakeServer], int]] = {
+    "validate_seed": bench_validate_seed,
+    "dbs": bench_dbs,
+    "parallel_iter_with_progress": bench_parallel_iter,
+    "batched": bench_batched,
+    "from_response": bench_from_response,
+}
+
+
+def measure(
+    server: FakeServer,
+    case: Callable[[FakeServer], int],
+    repeat: int = 3,
+    min_time: float = MIN_TIME,
+) -> dict[str, Any]:
+    """
+    Times case repeat times, running it back to back within each timing
+    until min_time has passed so that quick cases aren't lost in the noise,
+    and reports the median wall and CPU time of one run. Peak memory comes
+    from one more run under tracemalloc, which would otherwise skew the
+    timings.
+    """
+    walls, cpus = [], []
+    items = sent = 0
+    for _ in range(repeat):
+        before = server.requests()
+        wall, cpu = time.perf_counter(), time.process_time()
+        runs = 0
+        while runs == 0 or time.perf_counter() - wall < min_time:
+            items = case(server)
+            runs += 1
+        walls.append((time.perf_counter() - wall) / runs)
+        cpus.append((time.process_time() - cpu) / runs)
+        sent = (server.requests() - before) // runs
+
+    tracemalloc.start()
+    try:
+        case(server)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    wall = statistics.median(walls)
+    return {
+        "items": items,
+        "requests": sent,
+        "wall": wall,
+        "cpu": statistics.median(cpus),
+        "peak_memory": peak,
+        "items_per_second": items / wall if wall else 0,
+        "requests_per_second": sent / wall if wall else 0,
+    }
+
+
+def revision() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def run(
+    sizes: tuple[int, ...] = DEFAULT_SIZES,
+    cases: list[str] | None = None,
+    repeat: int = 3,
+    on_result: Callable[[dict[str, Any]], None] | None = None,
+) -> dict[str, Any]:
+    """
+    Runs each case against a fake server holding each number of databases,
+    returning a report that save and compare understand.
+    """
+    results = []
+    for size in sizes:
+        with FakeServer(size) as server:
+            for name in cases or list(CASES):
+                result = {"case": name, "size": size}
+                result.update(measure(server, CASES[name], repeat))
+                results.append(result)
+                if on_result is not None:
+                    on_result(result)
+
+    return {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "results": results,
+    }
+
+
+def save(report: dict[str, Any], path: str):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def load(path: str) -> dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(
+    old: dict[str, Any], new: dict[str, Any], threshold: float = 0.2
+) -> list[dict[str, Any]]:
+    """
+    Pairs up results for the same case and size in two reports. A result
+    regressed if its throughput fell, or its CPU time or peak memory grew,
+    by more than threshold (a fraction).
+    """
+    before = {(r["case"], r["size"]): r for r in old["results"]}
+    rows = []
+    for r in new["results"]:
+        o = before.get((r["case"], r["size"]))
+        if o is None:
+            continue
+        changes = {
+            "items_per_second": _change(o["items_per_second"], r["items_per_second"]),
+            "cpu": _change(o["cpu"], r["cpu"]),
+            "peak_memory": _change(o["peak_memory"], r["peak_memory"]),
+        }
+        regressed = (
+            changes["items_per_second"] < -threshold
+            or changes["cpu"] > threshold
+            or changes["peak_memory"] > threshold
+        )
+        rows.append(
+            {
+                "case": r["case"],
+                "size": r["size"],
+                "old": o,
+                "new": r,
+                "changes": changes,
+                "regressed": regressed,
+            }
+        )
+    return rows
+
+
+def _change(old: float, new: float) -> float:
+    return (new - old) / old if old else 0
@@ -1,17 +1,28 @@
+import functools
+from contextlib import AbstractContextManager, nullcontext
 from datetime import datetime, timedelta
 from time import sleep
 from typing import TYPE_CHECKING, Any, Generator, Iterable, cast
 from rich.progress import Progress, TaskID
 
-import docker
 import requests
 from couch.types import DBInfo, MembershipResponse, SystemResponse
 from docker.models.containers import Container
 from couch.http import HTTPMixin
-from utils import batched, random_string, status
-
+from utils import (
+    batched,
+    parallel_chain,
+    pipelined_map,
+    prefetch,
+    random_string,
+    status,
+)
+
+from .containers import docker_client
+from .convergence import ConvergenceTracker
 from .credentials import password, username
 from .db import DB
+from .scan import before, key_ranges, range_size, split_range
 
 if TYPE_CHECKING:
     from .cluster import Cluster
@@ -35,7 +46,7 @@ class Node(HTTPMixin):
 
     @staticmethod
     def create(cluster_name: str, image: str = "couchdb:3.2.1") -> "Node":
-        client = docker.from_env()
+        client = docker_client()
         id = random_string()
         node_name = f"cpg-{cluster_name}-{id}"
         client.volumes.create(name=node_name, labels={"cpg": cluster_name})
@@ -73,15 +84,16 @@ class Node(HTTPMixin):
 
     def get_config(self, section: str, key: str | None = None) -> Any:
         if key:
-            return self.get(f"/_node/_local/_config/{section}/{key}").json()
+            path = f"/_node/_local/_config/{section}/{key}"
         else:
-            return self.get(f"/_node/_local/_config/{section}").json()
+            path = f"/_node/_local/_config/{section}"
+        return self.get(path, coalesce=True).json()
 
     def set_config(self, section: str, key: str, value: Any) -> None:
         self.put(f"/_node/_local/_config/{section}/{key}", json=value)
 
     def config(self) -> dict[str, Any]:
-        return self.get("/_node/_local/_config").json()
+        return self.get("/_node/_local/_config", coalesce=True).json()
 
     def started_at(self) -> datetime:
         started_at = self.container.attrs["State"]["StartedAt"]  # type: ignore
@@ -99,7 +111,7 @@ class Node(HTTPMixin):
             if remove:
                 self.remove()
 
-            client = docker.from_env()
+            client = docker_client()
             self.container.stop()
             self.container.remove()
 
@@ -134,15 +146,20 @@ class Node(HTTPMixin):
     def base_url(self) -> str:
         return self.local_address
 
+    def track(self) -> AbstractContextManager:
+        if not hasattr(self, "cluster"):
+            return nullcontext()
+        return self.cluster.balancer.track(self)
+
     def ok(self) -> bool:
         try:
-            self.get("/_up", timeout=0.1, max_attempts=1)
+            self.get("/_up", timeout=0.1, max_attempts=1, coalesce=True)
             return True
         except requests.RequestException:
             return False
 
     def membership(self) -> MembershipResponse:
-        resp = self.get("/_membership")
+        resp = self.get("/_membership", coalesce=True)
         return resp.json()
 
     def total_dbs(self) -> int:
@@ -158,6 +175,23 @@ class Node(HTTPMixin):
         page_size: int = 100,
         start_key: str | None = None,
         end_key: str | None = None,
+        prefetch_pages: int = 1,
+    ) -> Generator[DB, None, None]:
+        """
+        Lists databases a page at a time. With prefetch_pages, the next
+        pages are fetched in the background while the caller works through
+        the current one.
+        """
+        dbs = self._dbs(page_size, start_key, end_key)
+        if prefetch_pages > 0:
+            dbs = prefetch(dbs, depth=page_size * prefetch_pages)
+        return dbs
+
+    def _dbs(
+        self,
+        page_size: int,
+        start_key: str | None,
+        end_key: str | None,
     ) -> Generator[DB, None, None]:
         while True:
             url = f"/_all_dbs?limit={page_size + 1}"
@@ -165,23 +199,78 @@ class Node(HTTPMixin):
                 url += f'&startkey="{start_key}"'
             if end_key:
                 url += f'&endkey="{end_key}"'
-            names = self.get(url).json()
-
-            for name in names[:page_size]:
+            # As in DB.list, read past the extra name rather than break, so the
+            # connection is reused for the next page.
+            next_key = None
+            for i, name in enumerate(self.stream("GET", url)):
+                if i == page_size:
+                    next_key = name
+                    continue
                 yield DB(self, name)
 
-            if len(names) == page_size + 1:
-                start_key = names[-1]
-            else:
+            if next_key is None:
                 break
+            start_key = next_key
+
+    def scan_dbs(
+        self,
+        partitions: int = 4,
+        start_key: str | None = None,
+        end_key: str | None = None,
+        ordered: bool = False,
+        nodes: list["Node"] | None = None,
+        page_size: int = 100,
+    ) -> Generator[DB, None, None]:
+        """
+        Lists databases by splitting the key range into partitions and
+        scanning them concurrently, spread across nodes (just this one by
+        default). With ordered, databases come back in name order.
+        """
+        nodes = nodes or [self]
+
+        def sample(skip: int) -> str | None:
+            url = f"/_all_dbs?limit=1&skip={skip}"
+            if start_key:
+                url += f'&startkey="{start_key}"'
+            if end_key:
+                url += f'&endkey="{end_key}"'
+            names = self.get(url).json()
+            return names[0] if names else None
+
+        boundaries = []
+        if partitions > 1:
+            total = self.total_dbs()
+            if start_key or end_key:
+                total = range_size(sample, total)
+            boundaries = split_range(sample, total, partitions)
+        ranges = key_ranges(boundaries, start_key, end_key)
+
+        def source(i: int) -> Iterable[DB]:
+            lo, hi = ranges[i]
+            node = nodes[i % len(nodes)]
+            if i == len(ranges) - 1:
+                return node._dbs(page_size, lo, hi)
+            assert hi is not None
+            return before(node._dbs(page_size, lo, hi), lambda db: db.name, hi)
+
+        yield from parallel_chain(
+            [functools.partial(source, i) for i in range(len(ranges))],
+            ordered=ordered,
+        )
 
     def dbs_info(
-        self, db_names: Iterable[str], page_size: int = 100
+        self, db_names: Iterable[str], page_size: int = 100, depth: int = 2
     ) -> Generator[DBInfo, None, None]:
-        for batch in batched(db_names, page_size):
-            infos: list[DBInfo] = self.post("/_dbs_info", json={"keys": batch}).json()
-            for info in infos:
-                yield info
+        """
+        Looks up info for db_names in batches, keeping up to depth batches
+        in flight at once.
+        """
+
+        def fetch(batch: tuple[str, ...]) -> list[DBInfo]:
+            return list(self.stream("POST", "/_dbs_info", json={"keys": batch}))
+
+        for infos in pipelined_map(fetch, batched(db_names, page_size), depth=depth):
+            yield from infos
 
     def system(self) -> SystemResponse:
         return self.get("/_node/_local/_system").json()
@@ -192,6 +281,7 @@ class Node(HTTPMixin):
         docs_per_db: int,
         pbar: Progress | None = None,
         task_id: TaskID | None = None,
+        partitions: int = 1,
     ):
         total = 0
         if pbar is not None and task_id is not None:
@@ -200,9 +290,8 @@ class Node(HTTPMixin):
                 total=num_dbs,
                 description=f"node:{self.index} validating seed data",
             )
-        for info in self.dbs_info(
-            (db.name for db in self.dbs(start_key="db-", end_key="db-\ufff0"))
-        ):
+        dbs = self.scan_dbs(partitions, start_key="db-", end_key="db-\ufff0")
+        for info in self.dbs_info(db.name for db in dbs):
             total += 1
             if pbar is not None and task_id is not None:
                 pbar.update(task_id, advance=1)
@@ -230,24 +319,24 @@ class Node(HTTPMixin):
                 description=f"✅ node:{self.index} validated seed data",
             )
 
-    def wait_for_seed(self, num_dbs: int, docs_per_db: int, timeout: int = 60):
+    def wait_for_seed(
+        self,
+        num_dbs: int,
+        docs_per_db: int,
+        timeout: int = 60,
+        use_db_updates: bool = False,
+    ) -> dict[str, datetime]:
+        tracker = ConvergenceTracker(
+            self, num_dbs, docs_per_db, use_db_updates=use_db_updates
+        )
         start = datetime.now()
         while True:
+            tracker.poll()
+            if tracker.done():
+                return tracker.converged
             elapsed = (datetime.now() - start).total_seconds()
             if elapsed > timeout:
                 raise Exception(
-                    f"timed out waiting for seed data to be created (elapsed={elapsed}s)"
+                    f"timed out waiting for seed data to be created (elapsed={elapsed}s, pending={len(tracker.pending)})"
                 )
             sleep(0.5)
-            total = 0
-            for info in self.dbs_info(
-                (db.name for db in self.dbs(start_key="db-", end_key="db-\ufff0"))
-            ):
-                if "error" in info:
-                    continue
-                if info["info"]["doc_count"] != docs_per_db:
-                    continue
-                total += 1
-            if total != num_dbs:
-                continue
-            break
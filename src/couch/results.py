@@ -0,0 +1,204 @@
+import json
+import os
+import statistics
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Generator
+
+from utils import random_string
+
+from .log import logger
+from .metrics import enable_metrics, metrics
+
+if TYPE_CHECKING:
+    from .cluster import Cluster
+
+_results_dir = os.path.expanduser("~/.cpg/results")
+
+
+def set_results_dir(path: str):
+    global _results_dir
+    _results_dir = path
+
+
+def results_dir() -> str:
+    return _results_dir
+
+
+class Run:
+    """
+    The record of one test scenario run: what it ran against, how long each
+    phase took, how many requests each phase made and how many failed, and
+    how it ended.
+    """
+
+    id: str
+    scenario: str
+    started: datetime
+    cluster: str
+    image: str
+    nodes: int
+    q: int | None
+    n: int | None
+    params: dict[str, Any]
+    phases: list[dict[str, Any]]
+    outcome: str
+
+    def __init__(self, scenario: str, cluster: "Cluster", **params):
+        self.started = datetime.now()
+        self.id = f"{self.started:%Y%m%d-%H%M%S}-{scenario}-{random_string(4)}"
+        self.scenario = scenario
+        self.cluster = cluster.name
+        self.image = cluster.nodes[0].image
+        self.nodes = len(cluster.nodes)
+        self.q = self.n = None
+        self.params = params
+        self.phases = []
+        self.outcome = "unknown"
+
+    def shards(self, cluster: "Cluster", db_name: str = "db-0"):
+        """Records q and n from one of the seeded databases."""
+        info = cluster.db(db_name).describe()
+        self.q = info["cluster"]["q"]
+        self.n = info["cluster"]["n"]
+
+    @contextmanager
+    def phase(self, name: str) -> Generator[None, None, None]:
+        """Times the body of the with block and counts its requests."""
+        requests, errors = metrics.totals()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            after_requests, after_errors = metrics.totals()
+            self.phases.append(
+                {
+                    "name": name,
+                    "seconds": seconds,
+                    "requests": after_requests - requests,
+                    "errors": after_errors - errors,
+                }
+            )
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "scenario": self.scenario,
+            "started": self.started.isoformat(timespec="seconds"),
+            "cluster": self.cluster,
+            "image": self.image,
+            "nodes": self.nodes,
+            "q": self.q,
+            "n": self.n,
+            "params": self.params,
+            "phases": self.phases,
+            "outcome": self.outcome,
+        }
+
+    def save(self) -> str:
+        os.makedirs(_results_dir, exist_ok=True)
+        path = os.path.join(_results_dir, f"{self.id}.json")
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        return path
+
+
+@contextmanager
+def record(scenario: str, cluster: "Cluster", **params) -> Generator[Run, None, None]:
+    """
+    Records a run of scenario against cluster, saving it to the results
+    store when the with block exits. The block should set run.outcome; if
+    it's interrupted or raises, that's recorded as the outcome instead.
+    """
+    enable_metrics()
+    run = Run(scenario, cluster, **params)
+    try:
+        yield run
+    except KeyboardInterrupt:
+        run.outcome = "interrupted"
+        raise
+    except Exception:
+        run.outcome = "error"
+        raise
+    finally:
+        # Failing to save mustn't hide how the scenario itself went.
+        try:
+            path = run.save()
+            logger.info(f"saved {scenario} result to {path}")
+        except OSError as e:
+            logger.warning(f"couldn't save {scenario} result: {e}")
+
+
+def load_runs(scenario: str | None = None) -> list[dict[str, Any]]:
+    """Every stored run, oldest first, optionally only those of scenario."""
+    if not os.path.isdir(_results_dir):
+        return []
+    runs = []
+    for name in sorted(os.listdir(_results_dir)):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(_results_dir, name)
+        try:
+            with open(path) as f:
+                run = json.load(f)
+            run_scenario = run["scenario"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"skipping unreadable result {path}: {e!r}")
+            continue
+        if scenario is None or run_scenario == scenario:
+            runs.append(run)
+    return runs
+
+
+def select(runs: list[dict[str, Any]], selector: str) -> list[dict[str, Any]]:
+    """Runs whose id is selector, or failing that, whose image is."""
+    by_id = [r for r in runs if r["id"] == selector]
+    return by_id or [r for r in runs if r["image"] == selector]
+
+
+def summarize(runs: list[dict[str, Any]]) -> dict[str, dict[str, float]]:
+    """
+    Per phase, the mean time a run spent in it and the fraction of its
+    requests that failed. Phases that repeat within a run, like the
+    iterations of lose_data, have their times summed per run first.
+    """
+    seconds: dict[str, list[float]] = {}
+    requests: dict[str, int] = {}
+    errors: dict[str, int] = {}
+    for run in runs:
+        totals: dict[str, float] = {}
+        for phase in run["phases"]:
+            name = phase["name"]
+            totals[name] = totals.get(name, 0) + phase["seconds"]
+            requests[name] = requests.get(name, 0) + phase["requests"]
+            errors[name] = errors.get(name, 0) + phase["errors"]
+        for name, total in totals.items():
+            seconds.setdefault(name, []).append(total)
+
+    return {
+        name: {
+            "seconds": statistics.mean(seconds[name]),
+            "error_rate": errors[name] / requests[name] if requests[name] else 0,
+        }
+        for name in seconds
+    }
+
+
+def compare(
+    old: list[dict[str, Any]], new: list[dict[str, Any]]
+) -> list[dict[str, Any]]:
+    """
+    Lines up the phases of two sets of runs of the same scenario, with the
+    mean time and error rate of each side and how the time changed.
+    """
+    before, after = summarize(old), summarize(new)
+    rows = []
+    for name in list(before) + [p for p in after if p not in before]:
+        o, n = before.get(name), after.get(name)
+        change = None
+        if o is not None and n is not None and o["seconds"]:
+            change = (n["seconds"] - o["seconds"]) / o["seconds"]
+        rows.append({"phase": name, "old": o, "new": n, "change": change})
+    return rows
@@ -0,0 +1,55 @@
+from itertools import takewhile
+from typing import Callable, Iterable, Iterator
+
+
+def split_range(
+    sample: Callable[[int], str | None], total: int, partitions: int
+) -> list[str]:
+    """
+    Picks up to partitions - 1 boundary keys by sampling the key at evenly
+    spaced offsets. sample(skip) should return the key that many rows into
+    the range, or None if the range is shorter than that. total is only an
+    estimate: if the range turns out shorter, fewer boundaries come back.
+    """
+    boundaries: list[str] = []
+    for i in range(1, partitions):
+        key = sample(i * total // partitions)
+        if key is None:
+            break
+        if not boundaries or key > boundaries[-1]:
+            boundaries.append(key)
+    return boundaries
+
+
+def range_size(sample: Callable[[int], str | None], total: int) -> int:
+    """
+    Counts the rows in a key range by binary searching for the first skip
+    that sample (as for split_range) finds nothing at. total must be at
+    least the range's size, e.g. the count of the whole database, and the
+    search takes about log2(total) samples.
+    """
+    lo, hi = 0, total
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if sample(mid) is None:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def key_ranges(
+    boundaries: list[str], start_key: str | None, end_key: str | None
+) -> list[tuple[str | None, str | None]]:
+    """
+    Turns boundaries into consecutive (start, end) ranges covering
+    start_key to end_key. Every range's end is exclusive except the last,
+    which keeps end_key's inclusive meaning.
+    """
+    starts: list[str | None] = [start_key, *boundaries]
+    ends: list[str | None] = [*boundaries, end_key]
+    return list(zip(starts, ends))
+
+
+def before[T](items: Iterable[T], key: Callable[[T], str], end: str) -> Iterator[T]:
+    return takewhile(lambda item: key(item) < end, items)
@@ -39,6 +39,33 @@ class DBInfo(TypedDict):
     error: NotRequired[str]
 
 
+class BulkDocResult(TypedDict):
+    id: str
+    rev: NotRequired[str]
+    error: NotRequired[str]
+    reason: NotRequired[str]
+
+
+class BulkGetResult(TypedDict):
+    id: str
+    rev: NotRequired[str]
+    doc: NotRequired[dict]
+    error: NotRequired[str]
+    reason: NotRequired[str]
+
+
+class ChangeRev(TypedDict):
+    rev: str
+
+
+class Change(TypedDict):
+    seq: str
+    id: str
+    changes: list[ChangeRev]
+    deleted: NotRequired[bool]
+    doc: NotRequired[dict]
+
+
 class MemoryInfo(TypedDict):
     other: int
     atom: int
@@ -1,13 +1,27 @@
+import asyncio
+import builtins
+import contextvars
 import functools
+import multiprocessing
+import os
+import queue
 import random
 import string
 import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from contextlib import contextmanager
 from datetime import timedelta
 from itertools import islice
-from typing import Callable, Generator, Iterable, Iterator
+from typing import Any, Awaitable, Callable, Generator, Iterable, Sized
 from rich.progress import (
     Progress,
     TextColumn,
@@ -16,15 +30,288 @@ from rich.progress import (
     TimeElapsedColumn,
 )
 from rich.console import Console
+from rich.status import Status
 
 from couch.log import logger
 
 
+class RateLimiter:
+    """
+    A token bucket: allows rate acquisitions per second on average, and up
+    to burst at once after a quiet spell. Callers that arrive when the
+    bucket is empty reserve a future token and sleep until it's due, so
+    waiters are served in arrival order.
+    """
+
+    rate: float
+    burst: int
+
+    def __init__(self, rate: float, burst: int = 1):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Takes a token and returns how long to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class SingleFlight[K, V]:
+    """
+    Lets concurrent callers asking for the same key share one call: the
+    first caller runs it and the others wait for its result, or its
+    exception. Once the call finishes, the next caller starts a new one.
+    """
+
+    shared: int
+
+    def __init__(self):
+        self.shared = 0
+        self._calls: dict[K, Future[V]] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: K, f: Callable[[], V]) -> V:
+        with self._lock:
+            waiting = self._calls.get(key)
+            if waiting is None:
+                future: Future[V] = Future()
+                self._calls[key] = future
+            else:
+                self.shared += 1
+        if waiting is not None:
+            return waiting.result()
+
+        try:
+            result = f()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+# Set while a pool thread is running items for some bounded_map.
+_worker = threading.local()
+
+
+class _Operation[T, R]:
+    """
+    One call to bounded_map. Its items wait in pending until one of at most
+    limit runners on the shared pool, or the calling thread itself, picks
+    them up.
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor, f: Callable[[T], R], limit: int):
+        self.executor = executor
+        self.f = f
+        self.limit = limit
+        self.runners = 0
+        self.pending: deque[tuple[contextvars.Context, T, Future[R]]] = deque()
+        self.lock = threading.Lock()
+
+    def submit(self, item: T) -> Future[R]:
+        future: Future[R] = Future()
+        with self.lock:
+            self.pending.append((contextvars.copy_context(), item, future))
+            spawn = self.runners < self.limit
+            if spawn:
+                self.runners += 1
+        if spawn:
+            self.executor.submit(self._runner)
+        return future
+
+    def _runner(self):
+        _worker.active = True
+        try:
+            while self.run_one():
+                pass
+        finally:
+            _worker.active = False
+        with self.lock:
+            self.runners -= 1
+            # An item may have been queued after we last looked.
+            respawn = bool(self.pending) and self.runners < self.limit
+            if respawn:
+                self.runners += 1
+        if respawn:
+            self.executor.submit(self._runner)
+
+    def run_one(self) -> bool:
+        with self.lock:
+            if not self.pending:
+                return False
+            ctx, item, future = self.pending.popleft()
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(ctx.run(self.f, item))
+            except BaseException as e:
+                future.set_exception(e)
+        return True
+
+    def cancel(self):
+        with self.lock:
+            for _, _, future in self.pending:
+                future.cancel()
+            self.pending.clear()
+
+
+_concurrency = 32
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def set_concurrency(n: int):
+    global _concurrency
+    _concurrency = n
+
+
+def concurrency() -> int:
+    return _concurrency
+
+
+def shared_executor() -> ThreadPoolExecutor:
+    """
+    The process-wide worker pool every parallel helper runs on. Its size
+    caps the total number of worker threads however helpers are nested.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=_concurrency, thread_name_prefix="cpg"
+            )
+        return _executor
+
+
+def _stop_executor():
+    # A lock held by a pool thread at the moment of a fork stays held in the
+    # child forever, so let the pool wind down first. It's only idle threads
+    # by then (process_map blocks the thread that forks), and the pool is
+    # made again on next use. A pool thread can't wait for itself to stop.
+    global _executor
+    if getattr(_worker, "active", False):
+        return
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+def _reset_executor():
+    # Only the forking thread survives in the child, so the pool's threads
+    # and any lock they held are gone. Start again from scratch.
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
+os.register_at_fork(before=_stop_executor, after_in_child=_reset_executor)
+
+
+def bounded_map[T, R](
+    f: Callable[[T], R],
+    iter: Iterable[T],
+    parallelism=16,
+    max_in_flight: int | None = None,
+    ordered: bool = True,
+    on_submit: Callable[[], None] | None = None,
+    executor: ThreadPoolExecutor | None = None,
+) -> Generator[R, None, None]:
+    """
+    Applies f to every item on the shared worker pool, using at most
+    parallelism of its threads, and pulling items from iter only as fast as
+    there's room for them: at most max_in_flight (by default twice the
+    parallelism) calls are queued or running at once. Results are yielded
+    in input order if ordered, otherwise as soon as each finishes. The
+    first error cancels everything still queued and is re-raised. Callers
+    that need more threads than --concurrency gives the shared pool can
+    pass an executor of their own.
+
+    When the caller is itself a pool thread, it runs queued items while it
+    waits. That keeps nested calls (e.g. a per-node fan-out inside a
+    per-cluster one) from deadlocking when every pool thread is busy
+    waiting on inner work. Other callers just wait, so they see the first
+    failure, and each result, as soon as it's ready.
+    """
+    if max_in_flight is None:
+        max_in_flight = parallelism * 2
+    op = _Operation(executor or shared_executor(), f, parallelism)
+    items = builtins.iter(iter)
+    futures: deque[Future[R]] = deque()
+    exhausted = False
+
+    def fill():
+        nonlocal exhausted
+        while not exhausted and len(futures) < max_in_flight:
+            try:
+                item = next(items)
+            except StopIteration:
+                exhausted = True
+                return
+            futures.append(op.submit(item))
+            if on_submit is not None:
+                on_submit()
+
+    def wait_for(candidates: Iterable[Future[R]]):
+        if getattr(_worker, "active", False) and op.run_one():
+            return
+        wait(candidates, return_when=FIRST_COMPLETED)
+
+    try:
+        fill()
+        while futures:
+            if ordered:
+                # Wait for the oldest call, but bail out as soon as any
+                # later one fails rather than when it reaches the front.
+                while not futures[0].done():
+                    for other in futures:
+                        if other.done() and other.exception() is not None:
+                            raise other.exception()  # type: ignore
+                    wait_for([other for other in futures if not other.done()])
+                future = futures.popleft()
+            else:
+                while not (done := [other for other in futures if other.done()]):
+                    wait_for(futures)
+                future = done[0]
+                futures.remove(future)
+            result = future.result()
+            fill()
+            yield result
+    finally:
+        op.cancel()
+
+
 def parallel_map[T, R](
-    f: Callable[[T], R], iter: Iterable[T], parallelism=16
-) -> Iterator[R]:
-    with ThreadPoolExecutor(max_workers=parallelism) as executor:
-        return executor.map(f, iter)
+    f: Callable[[T], R], iter: Iterable[T], parallelism=16, ordered: bool = True
+) -> Generator[R, None, None]:
+    return bounded_map(f, iter, parallelism=parallelism, ordered=ordered)
 
 
 def progress(**kwargs) -> Progress:
@@ -37,74 +324,273 @@ def progress(**kwargs) -> Progress:
     return Progress(*columns, expand=True, **kwargs)
 
 
+_statuses: list[Status] = []
+
+
 @contextmanager
 def status(text: str):
     console = Console()
-    with console.status(f" {text}"):
+    with console.status(f" {text}") as spinner:
+        _statuses.append(spinner)
         try:
             yield
         except Exception:
             console.print(f"❌ {text}")
             raise
+        finally:
+            _statuses.remove(spinner)
     console.print(f"✅ {text}")
 
 
+def _pause_statuses():
+    # Each spinner animates from a thread of its own, which mustn't be
+    # running when the process forks (see _stop_executor). Stopping only
+    # asks the thread to finish, so wait for it.
+    for spinner in _statuses:
+        thread = spinner._live._refresh_thread
+        spinner.stop()
+        if thread is not None:
+            thread.join()
+
+
+def _resume_statuses():
+    for spinner in _statuses:
+        spinner.start()
+
+
+def _forget_statuses():
+    _statuses.clear()
+
+
+os.register_at_fork(
+    before=_pause_statuses,
+    after_in_parent=_resume_statuses,
+    after_in_child=_forget_statuses,
+)
+
+
 def parallel_map_with_progress[T, R](
-    f: Callable[[T], R], iter: Iterable[T], parallelism=16, description: str = ""
+    f: Callable[[T], R],
+    iter: Iterable[T],
+    parallelism=16,
+    description: str = "",
+    ordered: bool = True,
+    total: int | None = None,
+    max_in_flight: int | None = None,
+    executor: ThreadPoolExecutor | None = None,
 ) -> Generator[R, None, None]:
-    with ThreadPoolExecutor(max_workers=parallelism) as executor:
-        with progress() as pbar:
-            task = pbar.add_task(description)
-            total = 0
-            futures = []
-            for i in iter:
-                total += 1
-                pbar.update(task, total=total)
-                futures.append(executor.submit(f, i))
-
-            for future in futures:
-                try:
-                    yield future.result()
-                except Exception:
-                    pbar.update(task, description=f"❌ {description}")
-                    raise
+    if total is None and isinstance(iter, Sized):
+        total = len(iter)
+
+    with progress() as pbar:
+        task = pbar.add_task(description, total=total)
+        submitted = 0
+
+        def on_submit():
+            nonlocal submitted
+            submitted += 1
+            if total is None:
+                pbar.update(task, total=submitted)
+
+        try:
+            for result in bounded_map(
+                f,
+                iter,
+                parallelism=parallelism,
+                max_in_flight=max_in_flight,
+                ordered=ordered,
+                on_submit=on_submit,
+                executor=executor,
+            ):
+                yield result
                 pbar.update(task, advance=1)
+        except Exception:
+            pbar.update(task, description=f"❌ {description}")
+            raise
 
-            pbar.update(task, description=f"✅ {description}")
+        pbar.update(task, description=f"✅ {description}")
 
 
 def parallel_iter_with_progress[T](
-    f: Callable[[T], None], iter: Iterable[T], parallelism=16, description: str = ""
+    f: Callable[[T], None],
+    iter: Iterable[T],
+    parallelism=16,
+    description: str = "",
+    total: int | None = None,
+    max_in_flight: int | None = None,
+    executor: ThreadPoolExecutor | None = None,
 ):
-    with ThreadPoolExecutor(max_workers=parallelism) as executor:
-        with progress() as pbar:
-            task = pbar.add_task(description)
-            futures = []
-            total = 0
-            for i in iter:
-                total += 1
-                pbar.update(task, total=total)
-                futures.append(executor.submit(f, i))
+    for _ in parallel_map_with_progress(
+        f,
+        iter,
+        parallelism=parallelism,
+        description=description,
+        ordered=False,
+        total=total,
+        max_in_flight=max_in_flight,
+        executor=executor,
+    ):
+        pass
 
-            for future in as_completed(futures):
-                try:
-                    future.result()
-                except Exception:
-                    pbar.update(task, description=f"❌ {description}")
-                    raise
-                pbar.update(task, advance=1)
 
-            pbar.update(task, description=f"✅ {description}")
+def parallel_iter[T](f: Callable[[T], None], iter: Iterable[T], parallelism=16):
+    for _ in bounded_map(f, iter, parallelism=parallelism, ordered=False):
+        pass
+
 
+async def async_parallel_iter_with_progress[T](
+    f: Callable[[T], Awaitable[None]],
+    iter: Iterable[T],
+    parallelism=16,
+    description: str = "",
+):
+    semaphore = asyncio.Semaphore(parallelism)
+    total = len(iter) if isinstance(iter, Sized) else None
 
-def parallel_iter[T](f: Callable[[T], None], iter: Iterable[T], parallelism=16):
-    with ThreadPoolExecutor(max_workers=parallelism) as executor:
-        futures = []
-        for i in iter:
-            futures.append(executor.submit(f, i))
+    with progress() as pbar:
+        task = pbar.add_task(description, total=total)
+
+        async def run(i: T):
+            try:
+                await f(i)
+            finally:
+                semaphore.release()
+            pbar.update(task, advance=1)
+
+        try:
+            # Only create a task once there's a slot for it to run in, so
+            # large inputs don't turn into a large number of pending tasks.
+            async with asyncio.TaskGroup() as tg:
+                submitted = 0
+                for i in iter:
+                    await semaphore.acquire()
+                    submitted += 1
+                    if total is None:
+                        pbar.update(task, total=submitted)
+                    tg.create_task(run(i))
+        except Exception:
+            pbar.update(task, description=f"❌ {description}")
+            raise
+
+        pbar.update(task, description=f"✅ {description}")
+
+
+def parallel_chain[T](
+    sources: list[Callable[[], Iterable[T]]], ordered: bool = True, depth: int = 1000
+) -> Generator[T, None, None]:
+    """
+    Runs each source on its own background thread, each staying up to
+    depth items ahead of the consumer. With ordered, yields everything from
+    the first source, then the second, and so on; otherwise yields items
+    from any source as soon as they're ready.
+    """
+    stop = threading.Event()
+    if ordered:
+        queues = [queue.Queue(maxsize=depth) for _ in sources]
+    else:
+        queues = [queue.Queue(maxsize=depth)] * len(sources)
+
+    def put(q: queue.Queue, entry: tuple[bool, Any]) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(q: queue.Queue, source: Callable[[], Iterable[T]]):
+        it = None
+        try:
+            it = iter(source())
+            for item in it:
+                if not put(q, (False, item)):
+                    return
+        except Exception as e:
+            put(q, (True, e))
+            return
+        finally:
+            close = getattr(it, "close", None)
+            if close is not None:
+                close()
+        put(q, (True, None))
+
+    for q, source in zip(queues, sources):
+        ctx = contextvars.copy_context()
+        threading.Thread(target=ctx.run, args=(produce, q, source), daemon=True).start()
+
+    try:
+        remaining = len(sources)
+        i = 0
+        while remaining > 0:
+            finished, value = queues[i].get()
+            if not finished:
+                yield value
+                continue
+            if value is not None:
+                raise value
+            remaining -= 1
+            if ordered:
+                i += 1
+    finally:
+        stop.set()
+
+
+def prefetch[T](iterable: Iterable[T], depth: int = 1) -> Generator[T, None, None]:
+    """
+    Runs iterable on a background thread, staying up to depth items ahead
+    of the consumer.
+    """
+    yield from parallel_chain([lambda: iterable], depth=depth)
+
+
+def pipelined_map[T, R](
+    f: Callable[[T], R], iterable: Iterable[T], depth: int = 2
+) -> Generator[R, None, None]:
+    """
+    Like map, but keeps up to depth calls to f in flight while the consumer
+    works through earlier results. Results are yielded in input order.
+    """
+    return bounded_map(f, iterable, parallelism=depth, max_in_flight=depth)
 
-        for future in as_completed(futures):
-            future.result()
+
+_forked: tuple[Callable[[Any], Any], list[Any]] | None = None
+
+
+def _run_forked(i: int) -> Any:
+    assert _forked is not None
+    f, items = _forked
+    return f(items[i])
+
+
+def process_map[T, R](
+    f: Callable[[T], R], iter: Iterable[T], processes: int | None = None
+) -> Generator[R, None, None]:
+    """
+    Applies f to every item in a pool of forked worker processes, one
+    process per item unless processes says otherwise, and yields results as
+    they finish. f and the items reach the workers by being inherited
+    across the fork rather than pickled, so f can close over anything; only
+    its results need to be picklable. Workers start with their own worker
+    pool and connections. The parent's pools and spinners are stopped over
+    each fork (see _stop_executor), so no thread can be holding a lock the
+    child needs.
+    """
+    global _forked
+    items = list(iter)
+    if not items:
+        return
+    _forked = (f, items)
+    try:
+        with ProcessPoolExecutor(
+            max_workers=processes or len(items),
+            mp_context=multiprocessing.get_context("fork"),
+        ) as pool:
+            futures = [pool.submit(_run_forked, i) for i in range(len(items))]
+            for future in as_completed(futures):
+                yield future.result()
+    finally:
+        _forked = None
 
 
 def random_string(length: int = 6) -> str:
@@ -144,43 +630,149 @@ def duration_to_human(delta: timedelta) -> str:
         return f"{seconds / 60 / 60 / 24:.0f}d"
 
 
+class RetryBudget:
+    """
+    Caps retries at a fraction of requests, so a struggling cluster isn't
+    buried under a retry storm. Every request that could be retried
+    deposits ratio tokens and every retry spends a whole one. min_per_second
+    tokens trickle in regardless, so a quiet client can still retry.
+    """
+
+    ratio: float
+    min_per_second: float
+    max_tokens: float
+    requests: int
+    retries: int
+    denied: int
+
+    def __init__(
+        self, ratio: float = 0.1, min_per_second: float = 10, max_tokens: float = 100
+    ):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.requests = 0
+        self.retries = 0
+        self.denied = 0
+        self._tokens = min(max_tokens, min_per_second)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, tokens: float):
+        now = time.monotonic()
+        tokens += (now - self._last) * self.min_per_second
+        self._tokens = min(self.max_tokens, self._tokens + tokens)
+        self._last = now
+
+    def deposit(self):
+        with self._lock:
+            self.requests += 1
+            self._refill(self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            self._refill(0)
+            if self._tokens < 1:
+                self.denied += 1
+                return False
+            self._tokens -= 1
+            self.retries += 1
+            return True
+
+
+class RetryPolicy:
+    """
+    Whether failed calls made under this policy may be retried, and the
+    budget their retries are drawn from. The current policy lives in a
+    context variable, so it follows work onto worker threads and tasks.
+    """
+
+    enabled: bool
+    budget: RetryBudget | None
+
+    def __init__(self, enabled: bool = True, budget: RetryBudget | None = None):
+        self.enabled = enabled
+        self.budget = budget
+
+    def replace(self, **changes) -> "RetryPolicy":
+        return RetryPolicy(
+            enabled=changes.get("enabled", self.enabled),
+            budget=changes.get("budget", self.budget),
+        )
+
+    def start(self, max_attempts: int):
+        # Calls that can't retry would only inflate the budget.
+        if self.budget is not None and max_attempts > 1:
+            self.budget.deposit()
+
+    def allow(self, attempts: int, max_attempts: int) -> bool:
+        if not self.enabled:
+            logger.debug("retries disabled, not retrying")
+            return False
+        if attempts >= max_attempts:
+            logger.debug("max retries reached, not retrying")
+            return False
+        if self.budget is not None and not self.budget.withdraw():
+            logger.debug("retry budget exhausted, not retrying")
+            return False
+        return True
+
+
+_retry_policy: contextvars.ContextVar[RetryPolicy] = contextvars.ContextVar(
+    "retry_policy", default=RetryPolicy(budget=RetryBudget())
+)
+
+
+def retry_policy() -> RetryPolicy:
+    return _retry_policy.get()
+
+
+def set_retry_policy(policy: RetryPolicy):
+    _retry_policy.set(policy)
+
+
+@contextmanager
+def using_retry_policy(policy: RetryPolicy):
+    token = _retry_policy.set(policy)
+    try:
+        yield policy
+    finally:
+        _retry_policy.reset(token)
+
+
 def retries_enabled() -> bool:
-    local = threading.local()
-    if not hasattr(local, "retries_enabled"):
-        local.retries_enabled = True
-    return local.retries_enabled
+    return retry_policy().enabled
 
 
 def disable_retries():
-    local = threading.local()
-    if not hasattr(local, "retries_enabled"):
-        local.retries_enabled = True
-    local.retries_enabled = False
+    set_retry_policy(retry_policy().replace(enabled=False))
 
 
 def enable_retries():
-    local = threading.local()
-    if not hasattr(local, "retries_enabled"):
-        local.retries_enabled = True
-    local.retries_enabled = True
+    set_retry_policy(retry_policy().replace(enabled=True))
 
 
-def retry(max_attempts: int = 3, initial_wait: float = 1, backoff_factor: float = 2):
+def retry(
+    max_attempts: int = 3,
+    initial_wait: float = 1,
+    backoff_factor: float = 2,
+    retry_if: Callable[[Exception], bool] | None = None,
+):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            policy = retry_policy()
+            policy.start(max_attempts)
             attempts = 0
             wait_time = initial_wait
-            while attempts < max_attempts:
+            while True:
                 try:
                     return func(*args, **kwargs)
-                except Exception:
+                except Exception as e:
                     attempts += 1
-                    if not retries_enabled():
-                        logger.debug("retries disabled, not retrying")
+                    if retry_if is not None and not retry_if(e):
                         raise
-                    if attempts == max_attempts:
-                        logger.debug("max retries reached, not retrying")
+                    if not policy.allow(attempts, max_attempts):
                         raise
                     time.sleep(wait_time + random.uniform(0, wait_time))
                     wait_time *= backoff_factor
@@ -190,14 +782,32 @@ def retry(max_attempts: int = 3, initial_wait: float = 1, backoff_factor: float
     return decorator
 
 
+def async_retry(
+    max_attempts: int = 3, initial_wait: float = 1, backoff_factor: float = 2
+):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            policy = retry_policy()
+            policy.start(max_attempts)
+            attempts = 0
+            wait_time = initial_wait
+            while True:
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    attempts += 1
+                    if not policy.allow(attempts, max_attempts):
+                        raise
+                    await asyncio.sleep(wait_time + random.uniform(0, wait_time))
+                    wait_time *= backoff_factor
+
+        return wrapper
+
+    return decorator
+
+
 @contextmanager
 def no_retries():
-    prev = retries_enabled()
-    disable_retries()
-    try:
+    with using_retry_policy(retry_policy().replace(enabled=False)):
         yield
-    finally:
-        if prev:
-            enable_retries()
-        else:
-            disable_retries()